@@ -0,0 +1,72 @@
+"""
+Microbenchmark counting the processes the manager forks per launch and per
+destroy.
+
+It drives a running manager through the REST API and reads the kernel's fork
+counter ("processes" in /proc/stat) around every call, so it works against
+any version of server.py. Run it on an otherwise idle host:
+
+    python3 bench/spawn_count.py --launches 20
+"""
+
+import argparse
+import json
+import statistics
+
+import requests
+
+CONFIG = {
+    "name": "spawnbench",
+    "major": "1",
+    "minor": "0",
+    "base_image": "basefs.tar.gz",
+    "mounts": [
+        "potato.tar /webserver/potato READ",
+        "tomato.tar /webserver/tomato READWRITE",
+    ],
+    "startup_script": "/bin/sleep 100000",
+    "startup_owner": "root",
+    "startup_env": "SPAWNBENCH=1",
+}
+
+
+def fork_count():
+    """
+    :return: the number of processes forked on this host since boot
+    """
+    with open('/proc/stat') as fp:
+        for line in fp:
+            if line.startswith('processes '):
+                return int(line.split()[1])
+    raise RuntimeError('no fork counter in /proc/stat')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--launches', default=10, type=int)
+    args = parser.parse_args()
+    url = 'http://{}:{}'.format(args.host, args.port)
+
+    session = requests.Session()
+    session.post(url + '/config', json=CONFIG)
+    launch_forks, destroy_forks = [], []
+    for _ in range(args.launches):
+        before = fork_count()
+        response = session.post(url + '/launch', json={key: CONFIG[key]
+                                                       for key in ('name', 'major', 'minor')})
+        response.raise_for_status()
+        launch_forks.append(fork_count() - before)
+        before = fork_count()
+        session.delete(url + '/destroy/' + response.json()['instance']).raise_for_status()
+        destroy_forks.append(fork_count() - before)
+    print(json.dumps({
+        'launches': args.launches,
+        'forks_per_launch': statistics.median(launch_forks),
+        'forks_per_destroy': statistics.median(destroy_forks),
+    }))
+
+
+if __name__ == '__main__':
+    main()
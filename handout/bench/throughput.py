@@ -0,0 +1,302 @@
+"""
+Launch/destroy throughput benchmark.
+
+It drives a running manager through the REST API at a fixed concurrency and
+runs three scenarios at each size N:
+
+    storm       N launches at once, then one /destroyall (not timed)
+    churn       N launch + destroy pairs, each worker looping
+    destroyall  N launches, then a timed /destroyall
+    ramp        N launches one at a time, keeping every instance, to see
+                whether launch latency grows with the number running
+
+Containers run a trivial local startup script (a long sleep) instead of
+tiny.sh, so the numbers measure the manager and not the workload. After every
+run the host is checked for container mounts, container processes and listed
+instances that outlived it. The report is JSON, to compare between versions:
+
+    python3 bench/throughput.py --sizes 10,100 --concurrency 16 --output before.json
+
+Launch latency against the number of running containers (it should stay
+flat, the containers' mounts live in their own mount namespaces):
+
+    python3 bench/throughput.py --scenarios ramp --sizes 500 --mounts
+"""
+
+import argparse
+import json
+import os
+import os.path as osp
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# an unusual sleep time, so leftover container processes can be found by it
+MARKER = '31337'
+CONFIG = {
+    "name": "throughputbench",
+    "major": "1",
+    "minor": "0",
+    "base_image": "basefs.tar.gz",
+    "mounts": [],
+    "startup_script": "/bin/sleep " + MARKER,
+    "startup_owner": "root",
+    "startup_env": "THROUGHPUTBENCH=1",
+}
+MOUNTS = [
+    "potato.tar /webserver/potato READ",
+    "tomato.tar /webserver/tomato READWRITE",
+]
+LAUNCH = {key: CONFIG[key] for key in ('name', 'major', 'minor')}
+
+
+def percentile(samples, fraction):
+    """
+    :param samples: sorted latencies
+    :param fraction: the percentile, between 0 and 1
+    :return: the nearest-rank percentile, None without samples
+    """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))]
+
+
+def summarize(latencies):
+    """
+    :param latencies: a dict of endpoint to latencies in seconds
+    :return: a dict of endpoint to count, p50, p95, p99 and max
+    """
+    res = {}
+    for endpoint, samples in latencies.items():
+        samples = sorted(samples)
+        res[endpoint] = {
+            'count': len(samples),
+            'p50': percentile(samples, 0.50),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+            'max': samples[-1] if samples else None,
+        }
+    return res
+
+
+def container_mounts(container_dir):
+    """
+    :param container_dir: the manager's containers directory
+    :return: mount points below it, except the warm pool's
+    """
+    prefix = osp.realpath(container_dir) + '/'
+    with open('/proc/self/mounts') as fp:
+        targets = [line.split(' ')[1] for line in fp]
+    return [target for target in targets
+            if target.startswith(prefix) and not target.startswith(prefix + '.warm/')]
+
+
+def host_mount_count():
+    """
+    :return: the number of entries in the host's mount table
+    """
+    with open('/proc/self/mountinfo') as fp:
+        return sum(1 for _ in fp)
+
+
+def container_processes():
+    """
+    :return: pids of processes started for benchmark containers
+    """
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(osp.join('/proc', pid, 'cmdline'), 'rb') as fp:
+                cmdline = fp.read().decode(errors='replace').split('\0')
+        except OSError:
+            continue
+        if 'sleep' in ' '.join(cmdline) and any(arg.endswith(MARKER) for arg in cmdline):
+            pids.append(int(pid))
+    return pids
+
+
+class Bench:
+    """
+    One benchmark session against a manager
+    """
+
+    def __init__(self, url, concurrency, container_dir):
+        self.url = url
+        self.concurrency = concurrency
+        self.container_dir = container_dir
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        # the workers of a run share its latencies and errors
+        self.lock = threading.Lock()
+
+    def call(self, latencies, errors, endpoint, method, path, **kwargs):
+        """
+        Send one request and record its latency under the endpoint name
+        :return: the response, or None if the request failed
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, **kwargs)
+        except requests.RequestException:
+            response = None
+        latency = time.perf_counter() - start
+        failed = response is None or response.status_code != 200
+        with self.lock:
+            latencies.setdefault(endpoint, []).append(latency)
+            if failed:
+                errors[endpoint] += 1
+        if failed:
+            return None
+        return response
+
+    def launch(self, latencies, errors):
+        response = self.call(latencies, errors, 'launch', 'POST', '/launch', json=LAUNCH)
+        return response.json()['instance'] if response is not None else None
+
+    def destroy(self, latencies, errors, instance_name):
+        if instance_name is not None:
+            self.call(latencies, errors, 'destroy', 'DELETE', '/destroy/' + instance_name)
+
+    def churn_worker(self, latencies, errors, count):
+        for _ in range(count):
+            self.destroy(latencies, errors, self.launch(latencies, errors))
+
+    def ramp(self, size):
+        """
+        Launch containers one at a time and keep them running
+        :param size: the number of containers
+        :return: the latency of each launch, in launch order, the errors and
+                the host mount table size before and after
+        """
+        latencies, errors = {}, Counter()
+        mounts_before = host_mount_count()
+        for _ in range(size):
+            self.launch(latencies, errors)
+        return latencies, errors, mounts_before, host_mount_count()
+
+    def run(self, scenario, size):
+        """
+        Run one scenario at one size
+        :param scenario: storm, churn, destroyall or ramp
+        :param size: the number of containers
+        :return: the run's report
+        """
+        latencies, errors = {}, Counter()
+        if scenario == 'ramp':
+            start = time.perf_counter()
+            latencies, errors, mounts_before, mounts_after = self.ramp(size)
+            wall = time.perf_counter() - start
+            self.session.delete(self.url + '/destroyall')
+            report = self.report(scenario, size, wall, latencies, errors)
+            launches = latencies.get('launch', [])
+            tenth = max(1, len(launches) // 10)
+            # median launch latency of each tenth of the ramp
+            report['ramp'] = {
+                'p50_by_decile': [percentile(sorted(launches[i:i + tenth]), 0.5)
+                                  for i in range(0, len(launches), tenth)],
+                'host_mounts_before': mounts_before,
+                'host_mounts_after': mounts_after,
+            }
+            return report
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            start = time.perf_counter()
+            if scenario == 'churn':
+                shares = [size // self.concurrency + (i < size % self.concurrency)
+                          for i in range(self.concurrency)]
+                list(pool.map(lambda count: self.churn_worker(latencies, errors, count), shares))
+            else:
+                list(pool.map(lambda _: self.launch(latencies, errors), range(size)))
+            if scenario == 'destroyall':
+                start = time.perf_counter()
+                self.call(latencies, errors, 'destroyall', 'DELETE', '/destroyall')
+            wall = time.perf_counter() - start
+        if scenario == 'storm':
+            self.session.delete(self.url + '/destroyall')
+        return self.report(scenario, size, wall, latencies, errors)
+
+    def report(self, scenario, size, wall, latencies, errors):
+        """
+        :return: the report of a run, with the leak checks done now
+        """
+        listed = self.session.get(self.url + '/list').json()['instances']
+        return {
+            'scenario': scenario,
+            'size': size,
+            'concurrency': self.concurrency,
+            'wall_seconds': wall,
+            'throughput': size / wall if wall > 0 else None,
+            'errors': dict(errors),
+            'latency': summarize(latencies),
+            'leaks': {
+                'mounts': len(container_mounts(self.container_dir)),
+                'processes': len(container_processes()),
+                'instances': len(listed),
+            },
+        }
+
+
+def manager_version(root_dir):
+    """
+    :param root_dir: the manager's directory
+    :return: the git revision of the manager, None outside a checkout
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=root_dir,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    root_dir = osp.dirname(osp.dirname(osp.realpath(__file__)))
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma separated numbers of containers')
+    parser.add_argument('--scenarios', default='storm,churn,destroyall',
+                        help='comma separated scenarios to run: storm, churn, destroyall, ramp')
+    parser.add_argument('--concurrency', default=16, type=int)
+    parser.add_argument('--mounts', action='store_true',
+                        help='give the containers the potato and tomato mounts')
+    parser.add_argument('--containers', default=osp.join(root_dir, 'containers'),
+                        help="the manager's containers directory, for the mount leak check")
+    parser.add_argument('--output', help='write the report to this file instead of stdout')
+    args = parser.parse_args()
+    url = 'http://{}:{}'.format(args.host, args.port)
+
+    config = dict(CONFIG, mounts=MOUNTS if args.mounts else [])
+    requests.post(url + '/config', json=config)
+    bench = Bench(url, args.concurrency, args.containers)
+    runs = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for scenario in args.scenarios.split(','):
+            runs.append(bench.run(scenario, size))
+            throughput = runs[-1]['throughput']
+            print('{scenario:>10} N={size:<5} {rate:>10}  leaks {leaks}'.format(
+                rate='{:.1f}/s'.format(throughput) if throughput is not None else 'n/a', **runs[-1]),
+                file=sys.stderr)
+    report = json.dumps({
+        'version': manager_version(root_dir),
+        'concurrency': args.concurrency,
+        'mounts': args.mounts,
+        'runs': runs,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
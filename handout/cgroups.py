@@ -0,0 +1,267 @@
+"""
+Per-instance cgroup v2 groups for the container manager.
+
+Every container gets its own group below a "containers" group next to the
+manager's own cgroup. Resource limits are written into it before the startup
+process is moved in, and teardown kills everything in the group at once with
+cgroup.kill, so no process can escape by leaving the process group.
+Failures are raised as syscalls.SyscallError like the other native
+operations.
+"""
+
+import errno
+import os
+import os.path as osp
+import threading
+import time
+
+from syscalls import SyscallError
+
+CONTROLLERS = ('cpu', 'io', 'memory', 'pids')
+
+lock = threading.Lock()
+# the name of the group holding every container group, next to the manager's
+group_name = 'containers'
+# the group holding every container group, None until set up or without cgroup v2
+parent_dir = None
+initialized = False
+
+
+def mount_point():
+    """
+    :return: where the cgroup v2 hierarchy is mounted, None if it is not
+    """
+    with open('/proc/self/mounts') as fp:
+        for line in fp:
+            fields = line.split(' ')
+            if fields[2] == 'cgroup2':
+                return fields[1].replace('\\040', ' ')
+    return None
+
+
+def own_group():
+    """
+    :return: the path of this process's cgroup v2 group in the hierarchy
+    """
+    with open('/proc/self/cgroup') as fp:
+        for line in fp:
+            if line.startswith('0::'):
+                return line[3:].strip()
+    return None
+
+
+def write(path, value):
+    """
+    Write a cgroup control file
+    :param path: the control file path
+    :param value: the value to write
+    :return: None
+    """
+    try:
+        with open(path, 'w') as fp:
+            fp.write(value)
+    except OSError as e:
+        raise SyscallError('cgroup', path, e.errno or errno.EIO)
+
+
+def enable_controllers(group_dir):
+    """
+    Delegate every available controller we use to a group's children
+    :param group_dir: the group directory
+    :return: None
+    """
+    with open(osp.join(group_dir, 'cgroup.controllers')) as fp:
+        available = fp.read().split()
+    for controller in CONTROLLERS:
+        if controller in available:
+            try:
+                write(osp.join(group_dir, 'cgroup.subtree_control'), '+' + controller)
+            except SyscallError as e:
+                print('cgroup: cannot enable {}: {}'.format(controller, e))
+
+
+def setup():
+    """
+    Find the cgroup v2 hierarchy and create the containers group, once. A
+    group with processes cannot hand controllers to its children, so the
+    manager first moves itself into a "manager" leaf of its own group
+    :return: the containers group directory, None without cgroup v2
+    """
+    global parent_dir, initialized
+    with lock:
+        if initialized:
+            return parent_dir
+        initialized = True
+        root, group = mount_point(), own_group()
+        if root is None or group is None:
+            return None
+        base_dir = osp.join(root, group.lstrip('/'))
+        try:
+            if group != '/':
+                os.makedirs(osp.join(base_dir, 'manager'), exist_ok=True)
+                write(osp.join(base_dir, 'manager', 'cgroup.procs'), str(os.getpid()))
+            enable_controllers(base_dir)
+            os.makedirs(osp.join(base_dir, group_name), exist_ok=True)
+            enable_controllers(osp.join(base_dir, group_name))
+        except (OSError, SyscallError) as e:
+            print('cgroup: disabled: {}'.format(e))
+            return None
+        parent_dir = osp.join(base_dir, group_name)
+        return parent_dir
+
+
+def create(name, resources):
+    """
+    Create a container's group and apply its limits
+    :param name: the group name
+    :param resources: control file name to value, from the launch plan
+    :return: the group directory, None without cgroup v2 and limits
+    :raises SyscallError: if the limits cannot be applied
+    """
+    containers_dir = setup()
+    if containers_dir is None:
+        if resources:
+            raise SyscallError('cgroup', None, errno.EOPNOTSUPP)
+        return None
+    group_dir = osp.join(containers_dir, name)
+    try:
+        os.mkdir(group_dir)
+    except FileExistsError:
+        # left over from an earlier container of the same name
+        remove(group_dir)
+        os.mkdir(group_dir)
+    except OSError as e:
+        raise SyscallError('cgroup', group_dir, e.errno)
+    try:
+        for control, value in resources.items():
+            if not osp.exists(osp.join(group_dir, control)):
+                # the controller is not available to us
+                raise SyscallError('cgroup', osp.join(group_dir, control), errno.EOPNOTSUPP)
+            write(osp.join(group_dir, control), value)
+    except SyscallError:
+        remove(group_dir)
+        raise
+    return group_dir
+
+
+def kill(group_dir):
+    """
+    SIGKILL every process in a group
+    :param group_dir: the group directory
+    :return: False if the kernel has no cgroup.kill, else True
+    """
+    if not osp.exists(osp.join(group_dir, 'cgroup.kill')):
+        return False
+    write(osp.join(group_dir, 'cgroup.kill'), '1')
+    return True
+
+
+def freeze(group_dir, frozen=True, timeout=2.0):
+    """
+    Freeze or thaw every process in a group and wait until the kernel has
+    done it
+    :param group_dir: the group directory
+    :param frozen: True to freeze, False to thaw
+    :param timeout: how long to wait for the group to change state
+    :return: False if the kernel has no cgroup.freeze, else True
+    """
+    if not osp.exists(osp.join(group_dir, 'cgroup.freeze')):
+        return False
+    write(osp.join(group_dir, 'cgroup.freeze'), '1' if frozen else '0')
+    state = 'frozen {}'.format(int(frozen))
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with open(osp.join(group_dir, 'cgroup.events')) as fp:
+                if state in fp.read():
+                    break
+        except FileNotFoundError:
+            break
+        time.sleep(0.005)
+    return True
+
+
+def populated(group_dir):
+    """
+    :param group_dir: the group directory
+    :return: whether any process is still in the group
+    """
+    try:
+        with open(osp.join(group_dir, 'cgroup.events')) as fp:
+            return 'populated 1' in fp.read()
+    except FileNotFoundError:
+        return False
+
+
+def wait_empty(group_dir, timeout=2.0):
+    """
+    Wait for the killed processes of a group to be gone
+    :param group_dir: the group directory
+    :param timeout: how long to wait
+    :return: whether the group is empty
+    """
+    deadline = time.time() + timeout
+    while populated(group_dir):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def remove(group_dir, timeout=2.0):
+    """
+    Remove a group once its killed processes are gone
+    :param group_dir: the group directory
+    :param timeout: how long to wait for the group to empty
+    :return: None
+    """
+    wait_empty(group_dir, timeout)
+    try:
+        os.rmdir(group_dir)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        raise SyscallError('cgroup', group_dir, e.errno)
+
+
+def processes(group_dir):
+    """
+    :param group_dir: the group directory
+    :return: the pids in the group
+    """
+    try:
+        with open(osp.join(group_dir, 'cgroup.procs')) as fp:
+            return [int(pid) for pid in fp.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def usage(group_dir):
+    """
+    Read a group's accounting. cpu.stat is always there, memory and io only
+    when their controllers are enabled
+    :param group_dir: the group directory
+    :return: cpu_seconds, and memory_bytes, io_read_bytes and
+            io_write_bytes when available
+    """
+    res = {}
+    try:
+        with open(osp.join(group_dir, 'cpu.stat')) as fp:
+            for line in fp:
+                key, value = line.split()
+                if key == 'usage_usec':
+                    res['cpu_seconds'] = int(value) / 1e6
+        if osp.exists(osp.join(group_dir, 'memory.current')):
+            with open(osp.join(group_dir, 'memory.current')) as fp:
+                res['memory_bytes'] = int(fp.read())
+        if osp.exists(osp.join(group_dir, 'io.stat')):
+            res['io_read_bytes'] = res['io_write_bytes'] = 0
+            with open(osp.join(group_dir, 'io.stat')) as fp:
+                for line in fp:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key in ('rbytes', 'wbytes'):
+                            res['io_read_bytes' if key == 'rbytes' else 'io_write_bytes'] += int(value)
+    except FileNotFoundError:
+        pass
+    return res
@@ -26,6 +26,37 @@ class ConfigTests(unittest.TestCase):
         self.assertEqual(response.status_code, 409)
         self.assertFalse(response.content)
 
+        # readiness probes of the wrong type
+        for readiness in [{"timeout": "5"}, {"timeout": 0}, {"port": "10000"},
+                          {"port": 70000}, {"port": True}, {"file": 1}]:
+            config = dict(MySupport.get_dict("first_config"), readiness=readiness)
+            response = requests.post(url, json=config)
+            self.assertEqual(response.status_code, 409)
+            self.assertFalse(response.content)
+
+        # names that would leave configs/ or the containers' cgroup
+        for name in ["", "../x", "a/b", ".."]:
+            config = dict(MySupport.get_dict("first_config"), name=name)
+            self.assertEqual(requests.post(url, json=config).status_code, 409)
+        config = dict(MySupport.get_dict("first_config"), minor="../../x")
+        self.assertEqual(requests.post(url, json=config).status_code, 409)
+
+        # json.loads takes NaN, which would make the probe wait forever
+        config = json.dumps(dict(MySupport.get_dict("first_config"), readiness={"timeout": float("nan")}))
+        response = requests.post(url, data=config, headers={"Content-Type": "application/json"})
+        self.assertEqual(response.status_code, 409)
+
+        for resources in ['{"cpu_max": Infinity}', '{"cpu_max": NaN}', '{"memory_max": Infinity}',
+                          '{"pids_max": -Infinity}']:
+            config = json.dumps(MySupport.get_dict("first_config"))[:-1] + ', "resources": ' + resources + '}'
+            response = requests.post(url, data=config, headers={"Content-Type": "application/json"})
+            self.assertEqual(response.status_code, 409)
+
+        # valid json that is not an object
+        for path in ["/config", "/launch", "/images", "/instances/nope/commit"]:
+            response = requests.post(MySupport.url(self.HOSTNAME, self.PORT, path), json=[1])
+            self.assertEqual(response.status_code, 409)
+
     def test_config(self):
         url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
         url_info = MySupport.url(self.HOSTNAME, self.PORT, "/cfginfo")
@@ -0,0 +1,129 @@
+import requests, unittest, time
+from MySupport import MySupport
+
+
+class ListTests(unittest.TestCase):
+    HOSTNAME = "host"
+    PORT = 80
+    # (name, major, minor) of the configs, and instances launched of each
+    VERSIONS = [("listname", "1", "0", 3), ("listname", "1", "1", 1), ("listname", "2", "0", 1),
+                ("othername", "1", "0", 1)]
+
+    def suite():
+        suite = unittest.TestSuite()
+        suite.addTest(ListTests('test_etag'))
+        suite.addTest(ListTests('test_paging'))
+        suite.addTest(ListTests('test_filters'))
+        suite.addTest(ListTests('test_state'))
+        return suite
+
+    def setUp(self):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        for name, major, minor, _ in self.VERSIONS:
+            config = dict(MySupport.get_dict("list_config"), name=name, major=major, minor=minor)
+            self.assertIn(requests.post(url, json=config).status_code, (200, 409))
+        self.launched = []
+
+    def tearDown(self):
+        for instance_name in self.launched:
+            MySupport.destroy(self.HOSTNAME, self.PORT, instance_name)
+
+    def launch(self, name, major, minor):
+        # tracked, so that tearDown destroys only this suite's instances
+        instance_name = MySupport.launch(self.HOSTNAME, self.PORT, {"name": name, "major": major, "minor": minor})
+        self.launched.append(instance_name)
+        return instance_name
+
+    def launch_all(self):
+        for name, major, minor, count in self.VERSIONS:
+            for _ in range(count):
+                self.launch(name, major, minor)
+
+    def get(self, path, **headers):
+        return requests.get(MySupport.url(self.HOSTNAME, self.PORT, path), headers=headers)
+
+    def test_etag(self):
+        for path in ["/list", "/cfginfo"]:
+            response = self.get(path)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            response = self.get(path, **{"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertFalse(response.content)
+            self.assertEqual(response.headers["ETag"], etag)
+
+        # a launch changes the list, an upload the config files
+        etag = self.get("/list").headers["ETag"]
+        self.launch("listname", "1", "0")
+        response = self.get("/list", **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        etag = self.get("/cfginfo").headers["ETag"]
+        config = dict(MySupport.get_dict("list_config"), name="etagname", minor=str(int(time.time() * 1000)))
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        self.assertEqual(requests.post(url, json=config).status_code, 200)
+        response = self.get("/cfginfo", **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_paging(self):
+        self.launch_all()
+
+        # pages of two follow each other until "next" is null
+        pages, cursor = [], ""
+        while True:
+            response = self.get("/list?name=listname&limit=2" + cursor)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            pages.append([instance["instance"] for instance in body["instances"]])
+            if body["next"] is None:
+                break
+            cursor = "&cursor=" + body["next"]
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), MySupport.listed(self.HOSTNAME, self.PORT, "?name=listname"))
+
+        # config files page by file name
+        files, cursor = [], ""
+        while True:
+            body = self.get("/cfginfo?name=listname&limit=1" + cursor).json()
+            files += body["files"]
+            if body["next"] is None:
+                break
+            cursor = "&cursor=" + body["next"]
+        self.assertEqual(files, ["listname-1-0.cfg", "listname-1-1.cfg", "listname-2-0.cfg"])
+
+        self.assertNotIn("next", self.get("/list").json())
+        for query in ["?limit=0", "?limit=x", "?limit=1&cursor=x"]:
+            self.assertEqual(self.get("/list" + query).status_code, 400)
+        self.assertEqual(self.get("/cfginfo?limit=-1").status_code, 400)
+
+    def test_filters(self):
+        self.launch_all()
+        for name, major, minor, count in self.VERSIONS:
+            query = "?name={}&major={}&minor={}".format(name, major, minor)
+            self.assertEqual(len(MySupport.listed(self.HOSTNAME, self.PORT, query)), count)
+        self.assertEqual(len(MySupport.listed(self.HOSTNAME, self.PORT, "?name=listname")), 5)
+        self.assertEqual(len(MySupport.listed(self.HOSTNAME, self.PORT, "?name=listname&major=1")), 4)
+        self.assertEqual(len(MySupport.listed(self.HOSTNAME, self.PORT, "?name=listname&minor=0")), 4)
+        self.assertEqual(MySupport.listed(self.HOSTNAME, self.PORT, "?name=nope"), [])
+
+        response = self.get("/cfginfo?name=listname&major=1")
+        self.assertEqual(response.json()["files"], ["listname-1-0.cfg", "listname-1-1.cfg"])
+        self.assertEqual(self.get("/cfginfo?name=othername").json()["files"], ["othername-1-0.cfg"])
+
+    def test_state(self):
+        running = self.launch("listname", "1", "0")
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        config = dict(MySupport.get_dict("list_config"), name="exitname", startup_script="/bin/sleep 0.2")
+        self.assertIn(requests.post(url, json=config).status_code, (200, 409))
+        exited = self.launch("exitname", "1", "0")
+
+        for _ in range(50):
+            if exited in MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited"):
+                break
+            time.sleep(0.1)
+        self.assertEqual(MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited&name=exitname"), [exited])
+        self.assertEqual(MySupport.listed(self.HOSTNAME, self.PORT, "?state=running&name=listname"), [running])
+        self.assertNotIn(exited, MySupport.listed(self.HOSTNAME, self.PORT))
+        self.assertEqual(MySupport.listed(self.HOSTNAME, self.PORT, "?state=frozen&name=listname"), [])
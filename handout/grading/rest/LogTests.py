@@ -0,0 +1,74 @@
+import requests, unittest, time
+from MySupport import MySupport
+
+
+class LogTests(unittest.TestCase):
+    HOSTNAME = "host"
+    PORT = 80
+
+    def suite():
+        suite = unittest.TestSuite()
+        suite.addTest(LogTests('test_logs'))
+        suite.addTest(LogTests('test_destroy_exited'))
+        suite.addTest(LogTests('test_empty_env'))
+        return suite
+
+    def setUp(self):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        response = requests.post(url, json=MySupport.get_dict("log_config"))
+        self.assertIn(response.status_code, (200, 409))
+
+    def logs(self, instance_name, query=""):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/instances/" + instance_name + "/logs" + query)
+        return requests.get(url, timeout=10)
+
+    def test_logs(self):
+        instance_name = MySupport.launch(self.HOSTNAME, self.PORT, MySupport.get_dict("log_launch"))
+
+        # stdout and stderr in the order they were written
+        response = self.logs(instance_name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, "one\ntwo\nthree\n")
+
+        response = self.logs(instance_name, "?tail=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, "two\nthree\n")
+
+        # since resumes after a byte offset
+        response = self.logs(instance_name, "?tail=1")
+        self.assertEqual(response.headers["X-Log-Offset"], "8")
+        response = self.logs(instance_name, "?since=4")
+        self.assertEqual(response.text, "two\nthree\n")
+        self.assertEqual(response.headers["X-Log-Offset"], "4")
+        self.assertEqual(self.logs(instance_name, "?since=100").text, "")
+
+        self.assertEqual(self.logs(instance_name, "?tail=x").status_code, 400)
+        self.assertEqual(self.logs(instance_name, "?since=-1").status_code, 400)
+        self.assertEqual(self.logs("nope").status_code, 404)
+        self.assertEqual(MySupport.destroy(self.HOSTNAME, self.PORT, instance_name), 200)
+
+    def test_destroy_exited(self):
+        instance_name = MySupport.launch(self.HOSTNAME, self.PORT, MySupport.get_dict("log_launch"))
+
+        # the container exits on its own and is kept with its output
+        for _ in range(50):
+            names = MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited")
+            if instance_name in names:
+                break
+            time.sleep(0.1)
+        self.assertIn(instance_name, names)
+        self.assertEqual(self.logs(instance_name).text, "one\ntwo\nthree\n")
+
+        # destroying it drops the output too, and ends followers
+        self.assertEqual(MySupport.destroy(self.HOSTNAME, self.PORT, instance_name), 200)
+        self.assertEqual(self.logs(instance_name).status_code, 404)
+        self.assertEqual(self.logs(instance_name, "?follow=1").status_code, 404)
+
+    def test_empty_env(self):
+        # no startup_env at all runs the script as it is
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        config = dict(MySupport.get_dict("log_config"), name="noenvname", startup_env="")
+        self.assertIn(requests.post(url, json=config).status_code, (200, 409))
+        instance_name = MySupport.launch(self.HOSTNAME, self.PORT, {"name": "noenvname", "major": "1", "minor": "0"})
+        self.assertEqual(self.logs(instance_name).text, "one\ntwo\nthree\n")
+        self.assertEqual(MySupport.destroy(self.HOSTNAME, self.PORT, instance_name), 200)
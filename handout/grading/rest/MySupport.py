@@ -1,3 +1,6 @@
+import requests
+
+
 class MySupport:
     @staticmethod
     def url(hostname, port, path):
@@ -5,6 +8,24 @@ class MySupport:
         url = "http://" + hostname + ":" + portstr + path
         return url
 
+    @staticmethod
+    def launch(hostname, port, payload):
+        # the name of the launched instance
+        response = requests.post(MySupport.url(hostname, port, "/launch"), json=payload)
+        assert response.status_code == 200, "launch returned {}".format(response.status_code)
+        return response.json()["instance"]
+
+    @staticmethod
+    def destroy(hostname, port, instance_name):
+        return requests.delete(MySupport.url(hostname, port, "/destroy/" + instance_name)).status_code
+
+    @staticmethod
+    def listed(hostname, port, query=""):
+        # the names of the instances /list returns
+        response = requests.get(MySupport.url(hostname, port, "/list" + query))
+        assert response.status_code == 200, "list returned {}".format(response.status_code)
+        return [instance["instance"] for instance in response.json()["instances"]]
+
     @staticmethod
     def get_dict(which):
         if which == "invalid":
@@ -86,5 +107,82 @@ class MySupport:
                 "major": "5",
                 "minor": "78",
             }
+        elif which == "stress_config":
+            return {
+                "name": "stressname",
+                "major": "1",
+                "minor": "0",
+                "base_image": "basefs.tar.gz",
+                "mounts": [
+                    "potato.tar /webserver/potato READ",
+                    "tomato.tar /webserver/tomato READWRITE",
+                ],
+                "startup_script": "/bin/sleep 100000",
+                "startup_owner": "root",
+                "startup_env": "STRESS=1"
+            }
+
+        elif which == "stress_launch":
+            return {
+                "name": "stressname",
+                "major": "1",
+                "minor": "0"
+            }
+        elif which == "log_config":
+            return {
+                "name": "logname",
+                "major": "1",
+                "minor": "0",
+                "base_image": "basefs.tar.gz",
+                "mounts": [],
+                "startup_script": "echo one; echo two >&2; echo three; /bin/sleep 0.5",
+                "startup_owner": "root",
+                "startup_env": "LOGS=1"
+            }
+
+        elif which == "log_launch":
+            return {
+                "name": "logname",
+                "major": "1",
+                "minor": "0"
+            }
+        elif which == "crash_config":
+            # the server it starts gets SIGKILL, so the script exits with 137
+            return {
+                "name": "crashname",
+                "major": "1",
+                "minor": "0",
+                "base_image": "basefs.tar.gz",
+                "mounts": [],
+                "startup_script": "echo run; /bin/sleep 10 & /bin/sleep 0.3; kill -9 $!; wait $!",
+                "startup_owner": "root",
+                "startup_env": "CRASH=1",
+                "restart": "on-failure"
+            }
+
+        elif which == "crash_never_config":
+            return dict(MySupport.get_dict("crash_config"), minor="1", restart="never")
+
+        elif which == "crash_launch":
+            return {
+                "name": "crashname",
+                "major": "1",
+                "minor": "0"
+            }
+
+        elif which == "crash_never_launch":
+            return dict(MySupport.get_dict("crash_launch"), minor="1")
+
+        elif which == "list_config":
+            return {
+                "name": "listname",
+                "major": "1",
+                "minor": "0",
+                "base_image": "basefs.tar.gz",
+                "mounts": [],
+                "startup_script": "/bin/sleep 1000",
+                "startup_owner": "root",
+                "startup_env": "LIST=1"
+            }
         else:
             return {}
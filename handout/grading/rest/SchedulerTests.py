@@ -0,0 +1,174 @@
+import requests, unittest, os, os.path as osp, sys, time, json, shutil, subprocess, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from MySupport import MySupport
+
+HANDOUT_DIR = osp.dirname(osp.dirname(osp.dirname(osp.realpath(__file__))))
+
+
+class VanishingBackend(BaseHTTPRequestHandler):
+    """
+    A backend that reports the most room of all but drops every launch, like
+    a manager that went away right after its /capacity
+    """
+
+    def do_GET(self):
+        body = json.dumps({"node": 9, "instances": 0, "max_instances": None, "configs": 0, "cpus": 1000,
+                           "load": 0, "memory_total_bytes": 1 << 40, "memory_available_bytes": 1 << 40})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_POST(self):
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(os.geteuid() == 0, "starts its own managers, which need root")
+class SchedulerTests(unittest.TestCase):
+    HOSTNAME = "localhost"
+    PORT = 8180
+    BACKEND_PORTS = [8181, 8182]
+    BINPACK_PORT = 8183
+    FALLBACK_PORT = 8184
+    VANISHING_PORT = 8185
+    MAX_INSTANCES = 3
+
+    def suite():
+        suite = unittest.TestSuite()
+        suite.addTest(SchedulerTests('test_replication'))
+        suite.addTest(SchedulerTests('test_placement'))
+        suite.addTest(SchedulerTests('test_binpack'))
+        suite.addTest(SchedulerTests('test_unreachable_backend'))
+        return suite
+
+    @classmethod
+    def setUpClass(cls):
+        # a fixed directory, each data directory gets a cgroup named after it
+        cls.data_dir = osp.join(HANDOUT_DIR, "nodes")
+        cls.processes = []
+        backends = ",".join("localhost:{}".format(port) for port in cls.BACKEND_PORTS)
+        for index, port in enumerate(cls.BACKEND_PORTS):
+            cls.start(["server.py", "--port", str(port), "--clean",
+                       "--data-dir", osp.join(cls.data_dir, str(index)),
+                       "--node-index", str(index), "--node-count", str(len(cls.BACKEND_PORTS))],
+                      MAX_INSTANCES=str(cls.MAX_INSTANCES))
+        cls.start(["scheduler.py", "--port", str(cls.PORT), "--backends", backends])
+        cls.start(["scheduler.py", "--port", str(cls.BINPACK_PORT), "--backends", backends,
+                   "--placement", "binpack"])
+        cls.vanishing = ThreadingHTTPServer(("localhost", cls.VANISHING_PORT), VanishingBackend)
+        threading.Thread(target=cls.vanishing.serve_forever, daemon=True).start()
+        cls.start(["scheduler.py", "--port", str(cls.FALLBACK_PORT), "--backends",
+                   "localhost:{},localhost:{}".format(cls.VANISHING_PORT, cls.BACKEND_PORTS[0])])
+        for port in cls.BACKEND_PORTS + [cls.PORT, cls.BINPACK_PORT, cls.FALLBACK_PORT]:
+            for _ in range(100):
+                try:
+                    requests.get(MySupport.url(cls.HOSTNAME, port, "/cfginfo"), timeout=1)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+
+    @classmethod
+    def start(cls, argv, **env):
+        cls.processes.append(subprocess.Popen([sys.executable] + argv, cwd=HANDOUT_DIR,
+                                              env=dict(os.environ, **env),
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    @classmethod
+    def tearDownClass(cls):
+        requests.delete(MySupport.url(cls.HOSTNAME, cls.PORT, "/destroyall"))
+        cls.vanishing.shutdown()
+        for process in cls.processes:
+            process.terminate()
+        for process in cls.processes:
+            process.wait()
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def setUp(self):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        response = requests.post(url, json=MySupport.get_dict("stress_config"))
+        self.assertIn(response.status_code, (200, 409))
+
+    def tearDown(self):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/destroyall")
+        self.assertEqual(requests.delete(url).status_code, 200)
+
+    def launch(self, port=None, **fields):
+        url = MySupport.url(self.HOSTNAME, port or self.PORT, "/launch")
+        return requests.post(url, json=dict(MySupport.get_dict("stress_launch"), **fields))
+
+    def listed(self, port=None):
+        response = requests.get(MySupport.url(self.HOSTNAME, port or self.PORT, "/list"))
+        self.assertEqual(response.status_code, 200)
+        return response.json()["instances"]
+
+    def test_replication(self):
+        # the config is on every backend, and a second upload is a conflict
+        for port in self.BACKEND_PORTS:
+            response = requests.get(MySupport.url(self.HOSTNAME, port, "/cfginfo"))
+            self.assertEqual(response.json()["files"], ["stressname-1-0.cfg"])
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        self.assertEqual(requests.post(url, json=MySupport.get_dict("stress_config")).status_code, 409)
+        response = requests.get(MySupport.url(self.HOSTNAME, self.PORT, "/cfginfo"))
+        self.assertEqual(response.json()["files"], ["stressname-1-0.cfg"])
+
+    def test_placement(self):
+        names = []
+        for _ in range(4):
+            response = self.launch()
+            self.assertEqual(response.status_code, 200)
+            names.append(response.json()["instance"])
+        response = self.launch(replicas=2)
+        self.assertEqual(response.status_code, 200)
+        names += [instance["instance"] for instance in response.json()["instances"]]
+
+        # least-loaded spreads evenly, and node indexes keep names unique
+        listed = self.listed()
+        self.assertEqual(sorted(instance["instance"] for instance in listed), sorted(names))
+        self.assertEqual(len(set(names)), 6)
+        for index, port in enumerate(self.BACKEND_PORTS):
+            node = "localhost:{}".format(port)
+            on_node = sorted(instance["instance"] for instance in listed if instance["node"] == node)
+            self.assertEqual(on_node, sorted(instance["instance"] for instance in self.listed(port)))
+            self.assertEqual(len(on_node), self.MAX_INSTANCES)
+            for name in on_node:
+                self.assertEqual((int(name.split("_")[-1]) - 1) % len(self.BACKEND_PORTS), index)
+
+        # the cluster is full
+        self.assertEqual(self.launch().status_code, 503)
+        capacity = requests.get(MySupport.url(self.HOSTNAME, self.PORT, "/capacity")).json()
+        self.assertEqual(capacity["instances"], 6)
+        self.assertEqual(capacity["max_instances"], 6)
+
+        # a single destroy goes to the instance's backend, destroyall to all
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/destroy/" + names[0])
+        self.assertEqual(requests.delete(url).status_code, 200)
+        self.assertEqual(requests.delete(url).status_code, 404)
+        self.assertEqual(len(self.listed()), 5)
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/destroyall")
+        self.assertEqual(requests.delete(url).status_code, 200)
+        self.assertEqual(self.listed(), [])
+        for port in self.BACKEND_PORTS:
+            self.assertEqual(self.listed(port), [])
+
+    def test_binpack(self):
+        # the first backend fills up before the second one is used
+        nodes = []
+        for _ in range(self.MAX_INSTANCES + 1):
+            response = self.launch(self.BINPACK_PORT)
+            self.assertEqual(response.status_code, 200)
+        for instance in self.listed(self.BINPACK_PORT):
+            nodes.append(instance["node"])
+        first, second = ["localhost:{}".format(port) for port in self.BACKEND_PORTS]
+        self.assertEqual(nodes.count(first), self.MAX_INSTANCES)
+        self.assertEqual(nodes.count(second), 1)
+
+    def test_unreachable_backend(self):
+        # the vanishing backend looks best, so every launch has to fall back
+        response = self.launch(self.FALLBACK_PORT)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(response.json()["instance"],
+                      [instance["instance"] for instance in self.listed(self.BACKEND_PORTS[0])])
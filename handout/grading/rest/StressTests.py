@@ -0,0 +1,58 @@
+import requests, unittest
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from MySupport import MySupport
+
+
+class StressTests(unittest.TestCase):
+    HOSTNAME = "host"
+    PORT = 80
+    LAUNCHES = 24
+    WORKERS = 8
+
+    def suite():
+        suite = unittest.TestSuite()
+        suite.addTest(StressTests('test_concurrent_launch'))
+        suite.addTest(StressTests('test_concurrent_churn'))
+        return suite
+
+    def setUp(self):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        response = requests.post(url, json=MySupport.get_dict("stress_config"))
+        self.assertIn(response.status_code, (200, 409))
+
+        self.launch = partial(MySupport.launch, self.HOSTNAME, self.PORT, MySupport.get_dict("stress_launch"))
+        self.destroy = partial(MySupport.destroy, self.HOSTNAME, self.PORT)
+        self.listed = partial(MySupport.listed, self.HOSTNAME, self.PORT, "?name=stressname")
+
+    def tearDown(self):
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            list(pool.map(self.destroy, self.listed()))
+
+    def test_concurrent_launch(self):
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            names = list(pool.map(lambda _: self.launch(), range(self.LAUNCHES)))
+
+        # every launch got its own name and all of them are listed
+        self.assertEqual(len(set(names)), self.LAUNCHES)
+        self.assertEqual(sorted(self.listed()), sorted(names))
+
+        # destroying each instance twice at once succeeds exactly once
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            codes = list(pool.map(self.destroy, names + names))
+        self.assertEqual(codes.count(200), self.LAUNCHES)
+        self.assertEqual(codes.count(404), self.LAUNCHES)
+        self.assertEqual(self.listed(), [])
+
+    def test_concurrent_churn(self):
+        def churn(_):
+            instance_name = self.launch()
+            return self.destroy(instance_name)
+
+        with ThreadPoolExecutor(self.WORKERS) as pool:
+            launched = pool.map(lambda _: self.launch(), range(self.LAUNCHES // 2))
+            churned = pool.map(churn, range(self.LAUNCHES))
+            survivors = list(launched)
+            self.assertEqual(list(churned), [200] * self.LAUNCHES)
+
+        self.assertEqual(sorted(self.listed()), sorted(survivors))
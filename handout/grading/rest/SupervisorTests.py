@@ -0,0 +1,62 @@
+import requests, unittest, time, sys, os.path as osp
+from MySupport import MySupport
+
+HANDOUT_DIR = osp.dirname(osp.dirname(osp.dirname(osp.realpath(__file__))))
+
+
+class SupervisorTests(unittest.TestCase):
+    HOSTNAME = "host"
+    PORT = 80
+
+    def suite():
+        suite = unittest.TestSuite()
+        suite.addTest(SupervisorTests('test_restart_on_failure'))
+        suite.addTest(SupervisorTests('test_restart_never'))
+        suite.addTest(SupervisorTests('test_backoff_limit'))
+        return suite
+
+    def setUp(self):
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/config")
+        for which in ["crash_config", "crash_never_config"]:
+            response = requests.post(url, json=MySupport.get_dict(which))
+            self.assertIn(response.status_code, (200, 409))
+
+    def test_restart_on_failure(self):
+        instance_name = MySupport.launch(self.HOSTNAME, self.PORT, MySupport.get_dict("crash_launch"))
+        url = MySupport.url(self.HOSTNAME, self.PORT, "/instances/" + instance_name + "/logs")
+
+        # every run writes a line to the same log
+        for _ in range(100):
+            if requests.get(url).text.count("run\n") >= 3:
+                break
+            time.sleep(0.1)
+        self.assertGreaterEqual(requests.get(url).text.count("run\n"), 3)
+        self.assertIn(instance_name, MySupport.listed(self.HOSTNAME, self.PORT))
+        self.assertNotIn(instance_name, MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited"))
+        self.assertEqual(MySupport.destroy(self.HOSTNAME, self.PORT, instance_name), 200)
+
+    def test_restart_never(self):
+        instance_name = MySupport.launch(self.HOSTNAME, self.PORT, MySupport.get_dict("crash_never_launch"))
+
+        # it stays listed as exited until destroyed
+        for _ in range(50):
+            if instance_name in MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited"):
+                break
+            time.sleep(0.1)
+        self.assertIn(instance_name, MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited"))
+        self.assertNotIn(instance_name, MySupport.listed(self.HOSTNAME, self.PORT))
+        self.assertEqual(MySupport.destroy(self.HOSTNAME, self.PORT, instance_name), 200)
+        self.assertNotIn(instance_name, MySupport.listed(self.HOSTNAME, self.PORT, "?state=exited"))
+
+    def test_backoff_limit(self):
+        # the manager itself, for the delay of a restart no test can wait for
+        sys.path.insert(0, HANDOUT_DIR)
+        try:
+            from server import restart_delay
+        finally:
+            sys.path.remove(HANDOUT_DIR)
+        policy = {"policy": "always", "max_restarts": None, "backoff": 0.1, "max_backoff": 30}
+        self.assertEqual(restart_delay(policy, 0), 0)
+        self.assertEqual(restart_delay(policy, 2), 0.2)
+        for restarts in [1025, 10 ** 6, 10 ** 30]:
+            self.assertEqual(restart_delay(policy, restarts), 30)
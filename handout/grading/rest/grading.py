@@ -1,8 +1,13 @@
 import sys, requests, unittest
 from ConfigTests import ConfigTests
 from LaunchTests import LaunchTests
+from ListTests import ListTests
 from ContainerTests import ContainerTests
 from CGITests import CGITests
+from StressTests import StressTests
+from LogTests import LogTests
+from SupervisorTests import SupervisorTests
+from SchedulerTests import SchedulerTests
 
 
 def run_full(hostname, port):
@@ -13,18 +18,32 @@ def run_full(hostname, port):
     ConfigTests.PORT = port
     LaunchTests.HOSTNAME = hostname
     LaunchTests.PORT = port
+    ListTests.HOSTNAME = hostname
+    ListTests.PORT = port
     ContainerTests.HOSTNAME = hostname
     ContainerTests.PORT = port
     CGITests.HOSTNAME = hostname
     CGITests.PORT = port
+    StressTests.HOSTNAME = hostname
+    StressTests.PORT = port
+    LogTests.HOSTNAME = hostname
+    LogTests.PORT = port
+    SupervisorTests.HOSTNAME = hostname
+    SupervisorTests.PORT = port
     runner = unittest.TextTestRunner()
 
     # to not run tests, comment them out here
     # you probably want to do this in-order
     results.append(runner.run(ConfigTests.suite()))
     results.append(runner.run(LaunchTests.suite()))
+    results.append(runner.run(ListTests.suite()))
     results.append(runner.run(ContainerTests.suite()))
     results.append(runner.run(CGITests.suite()))
+    results.append(runner.run(StressTests.suite()))
+    results.append(runner.run(LogTests.suite()))
+    results.append(runner.run(SupervisorTests.suite()))
+    # starts its own managers and schedulers on ports 8180-8185
+    results.append(runner.run(SchedulerTests.suite()))
 
     for result in results:
         print(result)
@@ -0,0 +1,113 @@
+"""
+Persistent instance state for the container manager.
+
+Changes are appended to a journal as one JSON record per line and replayed on
+top of the last snapshot at boot. Once the journal grows past a few times the
+size of the state it is folded into a new snapshot. Records are flushed but
+not fsync'ed: running containers do not survive a host crash either, so the
+state only has to survive the manager.
+"""
+
+import json
+import os
+import os.path as osp
+import threading
+
+
+def empty_state():
+    """
+    :return: the state of a manager that never ran
+    """
+    return {'counter': {}, 'instances': {}}
+
+
+def apply(state, record):
+    """
+    Apply one journal record to a state
+    :param state: the state, changed in place
+    :param record: a 'start' record (an instance's container is running) or
+            a 'destroy' record (an instance is gone)
+    :return: None
+    """
+    if record['op'] == 'start':
+        state['instances'][record['instance']] = record['entry']
+        config_name = record['entry']['record']['name']
+        state['counter'][config_name] = max(state['counter'].get(config_name, 0), record['counter'])
+    elif record['op'] == 'destroy':
+        state['instances'].pop(record['instance'], None)
+
+
+class Journal:
+    """
+    An append-only journal with snapshots in a directory
+    """
+
+    def __init__(self, state_dir, compact_after=1024):
+        self.state_dir = state_dir
+        self.snapshot_path = osp.join(state_dir, 'snapshot.json')
+        self.log_path = osp.join(state_dir, 'journal.log')
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        self.state = empty_state()
+        self.records = 0
+        self.fp = None
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal on top of it. A record torn
+        by a crash can only be the last one and is skipped
+        :return: the state
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        with self.lock:
+            self.state = empty_state()
+            if osp.exists(self.snapshot_path):
+                with open(self.snapshot_path) as fp:
+                    self.state = json.load(fp)
+            self.records = 0
+            if osp.exists(self.log_path):
+                good = 0
+                with open(self.log_path, 'rb') as fp:
+                    for line in fp:
+                        if not line.endswith(b'\n'):
+                            break
+                        try:
+                            apply(self.state, json.loads(line))
+                        except ValueError:
+                            break
+                        good += len(line)
+                        self.records += 1
+                # drop the torn tail, so new records start on a fresh line
+                os.truncate(self.log_path, good)
+            self.fp = open(self.log_path, 'a')
+            return json.loads(json.dumps(self.state))
+
+    def append(self, record):
+        """
+        Journal a record and apply it to the state
+        :param record: the record
+        :return: None
+        """
+        with self.lock:
+            apply(self.state, record)
+            if self.fp is None:
+                return
+            self.fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.fp.flush()
+            self.records += 1
+            if self.records > max(self.compact_after, 2 * len(self.state['instances'])):
+                self.compact()
+
+    def compact(self):
+        """
+        Write the state as the new snapshot and start an empty journal; the
+        caller holds the lock
+        :return: None
+        """
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.state, fp, separators=(',', ':'))
+        os.rename(tmp_path, self.snapshot_path)
+        self.fp.close()
+        self.fp = open(self.log_path, 'w')
+        self.records = 0
@@ -0,0 +1,142 @@
+"""
+Captured container output for the container manager.
+
+A container's stdout and stderr go to a FIFO in its instance directory,
+which the manager drains into a LogBuffer. The buffer keeps the last
+max_bytes of output in memory however much the container writes, and can
+also append every byte to a file on disk that is rotated once it reaches
+file_bytes, keeping a fixed number of older files. Offsets count every byte
+the instance ever wrote, so a reader that falls behind the buffer skips
+ahead to the oldest byte still there.
+"""
+
+import os
+import os.path as osp
+import threading
+
+
+class LogBuffer:
+    """
+    A bounded in-memory log with optional rotated files
+    """
+
+    def __init__(self, max_bytes, file_path=None, file_bytes=0, files=1):
+        self.max_bytes = max_bytes
+        self.file_path = file_path
+        self.file_bytes = file_bytes
+        self.files = files
+        self.condition = threading.Condition()
+        self.data = bytearray()
+        # the offset of the first byte still in the buffer
+        self.start = 0
+        self.closed = False
+        self.fp = None
+        self.file_size = 0
+
+    @property
+    def end(self):
+        """
+        :return: the offset after the last byte written
+        """
+        return self.start + len(self.data)
+
+    def write(self, data):
+        """
+        Append output, dropping the oldest bytes past max_bytes
+        :param data: the bytes
+        :return: None
+        """
+        with self.condition:
+            self.data += data
+            excess = len(self.data) - self.max_bytes
+            if excess > 0:
+                del self.data[:excess]
+                self.start += excess
+            if self.file_path is not None and not self.closed:
+                self.write_file(data)
+            self.condition.notify_all()
+
+    def write_file(self, data):
+        """
+        Append output to the log file, rotating it first if it would grow
+        past file_bytes; the caller holds the condition
+        :param data: the bytes
+        :return: None
+        """
+        if self.fp is not None and self.file_size + len(data) > self.file_bytes:
+            self.fp.close()
+            self.fp = None
+            for index in range(self.files - 1, 0, -1):
+                if osp.exists('{}.{}'.format(self.file_path, index)):
+                    os.rename('{}.{}'.format(self.file_path, index), '{}.{}'.format(self.file_path, index + 1))
+            if self.files > 0:
+                os.rename(self.file_path, self.file_path + '.1')
+            else:
+                os.unlink(self.file_path)
+        if self.fp is None:
+            os.makedirs(osp.dirname(self.file_path), exist_ok=True)
+            self.fp = open(self.file_path, 'ab')
+            self.file_size = self.fp.tell()
+        self.fp.write(data)
+        self.fp.flush()
+        self.file_size += len(data)
+
+    def read(self, offset=None):
+        """
+        :param offset: where to start, the oldest buffered byte by default
+        :return: the buffered bytes from the offset on, and the offset after
+                them
+        """
+        with self.condition:
+            offset = self.start if offset is None else max(offset, self.start)
+            return bytes(self.data[offset - self.start:]), self.end
+
+    def tail_offset(self, lines=None):
+        """
+        :param lines: a number of lines, None for all of the buffer
+        :return: the offset of the first of the last lines in the buffer
+        """
+        with self.condition:
+            if lines is None:
+                return self.start
+            if lines == 0:
+                return self.end
+            # a last line without its newline yet counts as a line
+            position = len(self.data) - 1 if self.data.endswith(b'\n') else len(self.data)
+            for _ in range(lines):
+                position = self.data.rfind(b'\n', 0, position)
+                if position < 0:
+                    return self.start
+            return self.start + position + 1
+
+    def wait(self, offset, timeout):
+        """
+        Wait for output after an offset
+        :param offset: the offset the reader is at
+        :param timeout: how long to wait
+        :return: False once the log is closed and the reader has it all,
+                else True
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.end > offset or self.closed, timeout)
+            return self.end > offset or not self.closed
+
+    def close(self, remove_files=False):
+        """
+        Stop the log and wake up its readers
+        :param remove_files: whether to delete the log files too
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+        if remove_files and self.file_path is not None:
+            for path in [self.file_path] + ['{}.{}'.format(self.file_path, index)
+                                            for index in range(1, self.files + 1)]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
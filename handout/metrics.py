@@ -0,0 +1,191 @@
+"""
+Minimal Prometheus metrics for the container manager.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus text
+exposition format. Recording a value is a dictionary lookup and an addition
+under a lock, so instrumentation can stay on in production.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                                        .replace('"', '\\"')
+                                                        .replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of every metric: a name, a help text and label names
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        """
+        :param labels: label values by name
+        :return: the label values in label name order
+        """
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """
+        :return: a list of (suffix, label values, extra labels, value)
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """
+        :return: the metric in the text exposition format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            _format_labels(self.labelnames, labelvalues, extra),
+                                            _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With a collect function the values are
+    computed when the metrics are rendered instead of being set
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.collect = collect
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Count the enclosed block as in flight while it runs
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.collect is not None:
+            values = {key if isinstance(key, tuple) else (key,): value
+                      for key, value in self.collect().items()}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [('', key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """
+    Observations counted into cumulative buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe how long the enclosed block takes
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        samples = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), counts[-1]))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+def render():
+    """
+    :return: every registered metric in the text exposition format
+    """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
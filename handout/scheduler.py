@@ -0,0 +1,361 @@
+"""
+Front scheduler for several container managers.
+
+It serves the manager's REST API and forwards it to N backend managers.
+Configs are replicated to every backend. Each launch is placed on a backend
+by the capacity the backends report on /capacity, either the least loaded
+one or, with --placement binpack, the fullest one with room left. /list,
+/cfginfo and /destroyall fan out to every backend in parallel over pooled
+keep-alive connections. Instance names stay unique when the backends are
+started with --node-index and --node-count. Several managers on one host
+stand in for separate nodes:
+
+    sudo python3 server.py --port 8081 --data-dir nodes/0 --node-index 0 --node-count 2
+    sudo python3 server.py --port 8082 --data-dir nodes/1 --node-index 1 --node-count 2
+    python3 scheduler.py --port 8080 --backends localhost:8081,localhost:8082
+"""
+
+from flask import Flask, request
+import os
+import argparse
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+app = Flask(__name__)
+
+backends = []
+placement = 'least-loaded'
+connect_timeout = 3.05
+read_timeout = 60
+fanout_workers = int(os.environ.get('FANOUT_WORKERS', '32'))
+fanout_executor = ThreadPoolExecutor(max_workers=fanout_workers)
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=fanout_workers))
+# every config uploaded through the scheduler, to replay to a backend that missed it
+configs = {}
+config_lock = threading.Lock()
+# where each instance and async operation lives
+instance_nodes = {}
+operation_nodes = {}
+node_lock = threading.Lock()
+
+
+def config_file_name(name, major, minor):
+    """
+    :param name: the config name
+    :param major: the major version
+    :param minor: the minor version
+    :return: the config's file name, as the managers name it
+    """
+    return '{}-{}-{}.cfg'.format(name, major, minor)
+
+
+def call(backend, method, path, timeout=read_timeout, **kwargs):
+    """
+    Send one request to a backend
+    :param backend: the backend's host:port
+    :param method: the http method
+    :param path: the path, with its leading slash
+    :param timeout: the read timeout, None to wait as long as it takes
+    :return: the response, None if the backend is unreachable
+    """
+    try:
+        return session.request(method, 'http://{}{}'.format(backend, path),
+                               timeout=(connect_timeout, timeout), **kwargs)
+    except requests.RequestException as e:
+        print('backend {}: {}'.format(backend, e))
+        return None
+
+
+def fan_out(method, path, targets=None, **kwargs):
+    """
+    Send the same request to several backends at once
+    :param method: the http method
+    :param path: the path
+    :param targets: the backends, all of them by default
+    :return: a list of (backend, response or None), in backend order
+    """
+    targets = backends if targets is None else targets
+    responses = fanout_executor.map(lambda backend: call(backend, method, path, **kwargs), targets)
+    return list(zip(targets, responses))
+
+
+def relay(response):
+    """
+    :param response: a backend's response
+    :return: the same response from the scheduler
+    """
+    return response.content, response.status_code, {
+        'Content-Type': response.headers.get('Content-Type', 'text/html; charset=utf-8')}
+
+
+@app.route('/config', methods=['POST'])
+def create_config_file():
+    """
+    Upload a config to every backend. A backend that is down gets it when a
+    launch is placed on it
+    :return: 200 if a backend took it, 409 if the backends rejected it (bad
+            or already there), 503 if no backend is reachable
+    """
+    config_obj = request.get_json(silent=True)
+    if not isinstance(config_obj, dict) or any(field not in config_obj for field in ['name', 'major', 'minor']):
+        return '', 409
+    config_file = config_file_name(config_obj['name'], config_obj['major'], config_obj['minor'])
+    with config_lock:
+        if config_file in configs:
+            return '', 409
+    statuses = [response.status_code for _, response in fan_out('POST', '/config', json=config_obj)
+                if response is not None]
+    if 200 in statuses:
+        with config_lock:
+            configs[config_file] = config_obj
+        return '', 200
+    return '', 409 if statuses else 503
+
+
+@app.route('/cfginfo', methods=['GET'])
+def list_config_files():
+    """
+    List the config files of every backend. Filters are passed on, paging
+    is not
+    :return: the union of the backends' config files, sorted
+    """
+    params = {key: value for key, value in request.args.items() if key not in ('limit', 'cursor')}
+    files = set()
+    for _, response in fan_out('GET', '/cfginfo', params=params):
+        if response is not None and response.status_code == 200:
+            files.update(response.json()['files'])
+    return {'files': sorted(files)}, 200
+
+
+@app.route('/capacity', methods=['GET'])
+def get_capacity():
+    """
+    Report the capacity of every backend
+    :return: each reachable backend's /capacity with its address in
+            "backend", the total instances and instance limit (None if a
+            backend has none), and the unreachable backends
+    """
+    capacities = fetch_capacities()
+    limits = [capacity['max_instances'] for capacity in capacities]
+    return {
+        'instances': sum(capacity['instances'] for capacity in capacities),
+        'max_instances': sum(limits) if None not in limits else None,
+        'backends': capacities,
+        'unavailable': [backend for backend in backends
+                        if backend not in [capacity['backend'] for capacity in capacities]],
+    }, 200
+
+
+def fetch_capacities():
+    """
+    :return: the /capacity of every reachable backend, with its address in
+            "backend", in backend order
+    """
+    capacities = []
+    for backend, response in fan_out('GET', '/capacity'):
+        if response is not None and response.status_code == 200:
+            capacities.append(dict(response.json(), backend=backend))
+    return capacities
+
+
+def place(capacities, count):
+    """
+    Pick the backends for some launches, counting each launch as one more
+    instance on its backend before placing the next. least-loaded takes the
+    backend with the fewest instances for its size (its max_instances, or
+    its cpus without one), then the most free memory; binpack takes the
+    backend with the most instances that still has room, so the first
+    backends fill up before the next ones are used
+    :param capacities: the backends' capacities
+    :param count: the number of launches
+    :return: a Counter of backend to launches, None if they do not all fit
+    """
+    loads = {capacity['backend']: capacity['instances'] for capacity in capacities}
+    res = Counter()
+    for _ in range(count):
+        candidates = [(index, capacity) for index, capacity in enumerate(capacities)
+                      if capacity['max_instances'] is None
+                      or loads[capacity['backend']] < capacity['max_instances']]
+        if not candidates:
+            return None
+        if placement == 'binpack':
+            _, capacity = max(candidates, key=lambda candidate: (loads[candidate[1]['backend']], -candidate[0]))
+        else:
+            _, capacity = min(candidates, key=lambda candidate: (
+                loads[candidate[1]['backend']] / (candidate[1]['max_instances'] or candidate[1]['cpus'] or 1),
+                -(candidate[1]['memory_available_bytes'] or 0), candidate[0]))
+        loads[capacity['backend']] += 1
+        res[capacity['backend']] += 1
+    return res
+
+
+@app.route('/launch', methods=['POST'])
+def launch_container():
+    """
+    Launch on the backend chosen by the placement policy. With "replicas"
+    the replicas are placed one by one, and each backend gets its share in
+    one batch launch; a list of "configs" goes to a single backend. A single
+    launch whose backend cannot be reached goes to the next best one
+    :return: the backend's response; for a spread batch the instances of
+            every backend, with 200 if they were all launched, else 207 (202
+            with the operations when async). 503 if the cluster is full or
+            no backend is reachable
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return '', 409
+    replicas = payload.get('replicas')
+    if isinstance(replicas, bool) or (replicas is not None and (not isinstance(replicas, int) or replicas < 1)):
+        return '', 409
+    capacities = fetch_capacities()
+    while replicas is None:
+        assignment = place(capacities, 1)
+        if not assignment:
+            return '', 503
+        backend = next(iter(assignment))
+        response = launch_on(backend, payload)
+        if response is not None:
+            return relay(response)
+        # it went away since it reported its capacity, try the next best one
+        capacities = [capacity for capacity in capacities if capacity['backend'] != backend]
+    assignment = place(capacities, replicas)
+    if not assignment:
+        return '', 503
+    responses = list(zip(assignment, fanout_executor.map(
+        lambda backend: launch_on(backend, dict(payload, replicas=assignment[backend])), assignment)))
+    merged, statuses = [], set()
+    key = 'operations' if payload.get('async') else 'instances'
+    for backend, response in responses:
+        statuses.add(response.status_code if response is not None else 503)
+        if response is not None and response.status_code in (200, 202, 207):
+            merged += response.json()[key]
+    if statuses <= {200, 202}:
+        status = statuses.pop()
+    else:
+        status = 207 if merged else 503
+    return {key: merged}, status
+
+
+def launch_on(backend, payload):
+    """
+    Forward a launch to a backend, first giving it the config if it missed
+    the upload, and remember where the instances and operations went
+    :param backend: the backend
+    :param payload: the launch payload
+    :return: the backend's response, None if it is unreachable
+    """
+    response = call(backend, 'POST', '/launch', timeout=None, json=payload)
+    if response is not None and response.status_code == 409:
+        with config_lock:
+            config_obj = configs.get(config_file_name(payload.get('name'), payload.get('major'),
+                                                      payload.get('minor')))
+        if config_obj is not None and call(backend, 'POST', '/config', json=config_obj) is not None:
+            response = call(backend, 'POST', '/launch', timeout=None, json=payload)
+    if response is None or response.status_code not in (200, 202, 207, 504):
+        return response
+    body = response.json()
+    with node_lock:
+        for record in body.get('instances', [body]):
+            if 'instance' in record:
+                instance_nodes[record['instance']] = backend
+        for operation in body.get('operations', [body]):
+            if 'operation' in operation:
+                operation_nodes[operation['operation']] = backend
+    return response
+
+
+@app.route('/operations/<operation_id>', methods=['GET'])
+def get_operation(operation_id):
+    """
+    :param operation_id: an async launch's operation id
+    :return: the operation's status from its backend, 404 if unknown
+    """
+    with node_lock:
+        backend = operation_nodes.get(operation_id)
+    response = call(backend, 'GET', '/operations/' + operation_id) if backend is not None else None
+    if response is None:
+        return '', 404
+    return relay(response)
+
+
+@app.route('/list', methods=['GET'])
+def list_instances():
+    """
+    List the instances of every backend, fetched in parallel. Filters are
+    passed on, paging is not. Each instance has its backend in "node"
+    :return: the instances, backend by backend, and the unreachable
+            backends in "unavailable" if there are any
+    """
+    params = {key: value for key, value in request.args.items() if key not in ('limit', 'cursor')}
+    res = {'instances': []}
+    unavailable = []
+    for backend, response in fan_out('GET', '/list', params=params):
+        if response is None or response.status_code != 200:
+            unavailable.append(backend)
+            continue
+        records = response.json()['instances']
+        with node_lock:
+            for record in records:
+                instance_nodes[record['instance']] = backend
+        res['instances'] += [dict(record, node=backend) for record in records]
+    if unavailable:
+        res['unavailable'] = unavailable
+    return res, 200
+
+
+@app.route('/destroy/<instance_name>', methods=['DELETE'])
+def destroy_a_running_instance(instance_name):
+    """
+    Destroy an instance on its backend. An instance the scheduler has not
+    seen is looked for on every backend
+    :param instance_name: the instance name
+    :return: 200, or 404 if no backend has the instance
+    """
+    with node_lock:
+        backend = instance_nodes.pop(instance_name, None)
+    targets = [backend] if backend is not None else backends
+    statuses = [response.status_code for _, response in
+                fan_out('DELETE', '/destroy/' + instance_name, targets=targets, timeout=None)
+                if response is not None]
+    return '', 200 if 200 in statuses else 404
+
+
+@app.route('/destroyall', methods=['DELETE'])
+def destroy_all():
+    """
+    Destroy every instance of every backend, in parallel
+    :return: 200, or 503 if a backend is unreachable
+    """
+    responses = fan_out('DELETE', '/destroyall', timeout=None)
+    with node_lock:
+        instance_nodes.clear()
+    return '', 200 if all(response is not None for _, response in responses) else 503
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--backends', required=True,
+                        help='comma separated host:port of the managers')
+    parser.add_argument('--placement', choices=['least-loaded', 'binpack'], default='least-loaded')
+    parser.add_argument('--production', action='store_true',
+                        help='serve with waitress instead of the Flask development server')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='worker threads of the production server')
+    args = parser.parse_args()
+    backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    placement = args.placement
+    if args.production:
+        try:
+            from waitress import serve
+        except ImportError:
+            sys.exit('--production needs waitress, run "make install" first')
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        app.run(host=args.host, port=args.port, threaded=True)
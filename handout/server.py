@@ -12,135 +12,1717 @@ This server basally use Flask as the http server to listen on http
 request. The command "make manager" can run this server.
 """
 
-from flask import Flask, request
+from flask import Flask, Response, request
 import os
 import os.path as osp
 import json
+import math
 import copy
+import errno
 import time
-from collections import Counter, OrderedDict
-from multiprocessing import Process
+import hashlib
+import heapq
+import threading
+import atexit
+import socket
+import uuid
+import bisect
+import posixpath
+from stat import S_IMODE, S_ISCHR, S_ISREG
+import argparse
+import selectors
+import subprocess
+import shlex
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
+
+import cgroups
+import journal
+import logs
+import metrics
+import syscalls
 
 import signal
+import sys
 
 app = Flask(__name__)
 
 root_dir = osp.dirname(osp.realpath(__file__))
 config_dir = osp.join(root_dir, 'configs')
 container_dir = osp.join(root_dir, 'containers')
+base_images_dir = osp.join(root_dir, 'base_images')
+image_cache_dir = osp.join(root_dir, 'images')
+# one hard link per distinct file of every imported image
+image_object_dir = osp.join(image_cache_dir, '.objects')
+layer_dir = osp.join(root_dir, 'layers')
+image_manifest_dir = osp.join(root_dir, 'manifests')
+mountables_dir = osp.join(root_dir, 'mountables')
+mountable_store_dir = osp.join(mountables_dir, '.store')
+warm_dir = osp.join(container_dir, '.warm')
+trash_dir = osp.join(container_dir, '.trash')
+state_dir = osp.join(root_dir, 'state')
+log_dir = osp.join(root_dir, 'logs')
+# instance numbers are node_index + 1 + k * node_count, unique in a cluster
+node_index = 0
+node_count = 1
+max_instances = int(os.environ.get('MAX_INSTANCES', '0'))
+warm_pool_size = int(os.environ.get('WARM_POOL_SIZE', '0'))
+mountable_cache_bytes = int(os.environ.get('MOUNTABLE_CACHE_BYTES', str(1 << 30)))
+launch_timeout = float(os.environ.get('LAUNCH_TIMEOUT', '10'))
+launch_settle = float(os.environ.get('LAUNCH_SETTLE', '0.1'))
+launch_workers = int(os.environ.get('LAUNCH_WORKERS', '8'))
+teardown_workers = int(os.environ.get('TEARDOWN_WORKERS', '8'))
+stats_interval = float(os.environ.get('STATS_INTERVAL', '1'))
+hibernate_delay = float(os.environ.get('HIBERNATE_AFTER', '0'))
+hibernation_poll = 0.1
+log_buffer_bytes = int(os.environ.get('LOG_BUFFER_BYTES', str(64 << 10)))
+# rotate each instance's log file at this size, 0 for no log files
+log_file_bytes = int(os.environ.get('LOG_FILE_BYTES', '0'))
+log_files = int(os.environ.get('LOG_FILES', '3'))
+# cpu seconds an instance may use between two stats samples and still be idle
+idle_cpu_seconds = 0.01
+max_operations = 1024
+# overlayfs takes every lower directory in one mount option string
+max_image_layers = 32
+max_events = int(os.environ.get('EVENT_BUFFER', '1024'))
+event_keepalive = 15
+# each open stream holds a server thread, so only this many at once
+max_streams = int(os.environ.get('MAX_STREAMS', '8'))
+# streams end after this long, clients reconnect where they left off
+stream_window = float(os.environ.get('STREAM_WINDOW', '300'))
+open_streams = 0
+stream_lock = threading.Lock()
+configs = {}
+config_files = []
+config_lock = threading.Lock()
 instance_counter = Counter()
 instances = OrderedDict()
 container_dict = {}
+container_cgroups = {}
+instance_seqs = {}
+instance_generation = 0
+config_generation = 0
+# part of every etag, so etags from before a restart never match
+boot_id = uuid.uuid4().hex[:8]
+registry_lock = threading.Lock()
+instance_journal = journal.Journal(state_dir)
+image_lock = threading.Lock()
+image_commits = set()
+# imported base image name to (tarball digest, root directory)
+image_roots = {}
+tar_digests = {}
+store_lock = threading.Lock()
+store_key_locks = {}
+store_entries = OrderedDict()
+store_refs = Counter()
+store_adopted = False
+mountable_users = {}
+warm_pools = {}
+warm_pool_stats = {}
+warm_pool_lock = threading.Lock()
+warm_pool_queue = Queue()
+warm_pool_counter = Counter()
+warm_pool_thread = None
+operations = OrderedDict()
+operation_lock = threading.Lock()
+launch_executor = ThreadPoolExecutor(max_workers=launch_workers)
+teardown_executor = ThreadPoolExecutor(max_workers=teardown_workers)
+trash_pending = OrderedDict()
+trash_counter = Counter()
+trash_lock = threading.Lock()
+trash_queue = Queue()
+trash_thread = None
+reaper_selector = selectors.DefaultSelector()
+reaper_watched = {}
+reaper_lock = threading.Lock()
+reaper_wakeup = os.pipe()
+reaper_thread = None
+# (due time, instance name, exited process) of each scheduled restart
+restart_queue = []
+# supervised instance name to when its container was (re)started
+supervised_instances = {}
+restarting_instances = {}
+restart_counts = Counter()
+exited_instances = {}
+instance_stats = {}
+stats_lock = threading.Lock()
+stats_thread = None
+frozen_instances = {}
+idle_since = {}
+hibernation_lock = threading.Lock()
+hibernation_thread = None
+instance_logs = {}
+log_fds = {}
+log_closing = []
+log_selector = selectors.DefaultSelector()
+log_lock = threading.Lock()
+log_wakeup = os.pipe()
+log_thread = None
+events = deque(maxlen=max_events)
+event_counter = 0
+event_condition = threading.Condition()
+launch_phase_seconds = metrics.Histogram('container_launch_phase_seconds',
+                                         'Time spent in each phase of provisioning and starting an instance',
+                                         ['phase'])
+teardown_phase_seconds = metrics.Histogram('container_teardown_phase_seconds',
+                                           'Time spent in each phase of destroying an instance',
+                                           ['phase'])
+launch_seconds = metrics.Histogram('container_launch_seconds',
+                                   'Time from the start of a launch to its result', ['result'])
+launches_total = metrics.Counter('container_launches_total',
+                                 'Launches by config and result', ['config', 'result'])
+teardowns_total = metrics.Counter('container_teardowns_total',
+                                  'Destroyed instances by config', ['config'])
+restarts_total = metrics.Counter('container_restarts_total',
+                                 'Containers restarted by their restart policy, by config', ['config'])
+operations_in_flight = metrics.Gauge('container_operations_in_flight',
+                                     'Launches and teardowns in progress', ['kind'])
+running_instances = metrics.Gauge('container_running_instances',
+                                  'Running instances per config', ['config'],
+                                  collect=lambda: count_running_instances())
+warm_pool_roots = metrics.Gauge('container_warm_pool_roots',
+                                'Provisioned roots waiting in each warm pool', ['config'],
+                                collect=lambda: {config_file: len(pool)
+                                                 for config_file, pool in list(warm_pools.items())})
+trash_pending_dirs = metrics.Gauge('container_trash_pending_dirs',
+                                   'Destroyed container directories not deleted yet',
+                                   collect=lambda: {(): len(trash_pending)})
+launch_results = {200: 'ready', 404: 'destroyed', 500: 'exited', 504: 'timeout'}
 
 
 @app.route('/config', methods=['POST'])
 def create_config_file():
     """
-    Create a configuration file
+    Create a configuration file. The config is validated and compiled into a
+    launch plan here, so bad mount specs are rejected before any launch
     :returns: Return 200 if success, return 409 if the json is wrong
     """
-    if not osp.exists(config_dir):
-        os.makedirs(config_dir)
+    create_dir_if_not_exists(config_dir)
     config_obj = request.get_json(silent=True)
     if config_obj is None:
         return '', 409
-    for field in ['name', 'major', 'minor', 'base_image',
-                  'mounts', 'startup_script', 'startup_owner',
-                  'startup_env']:
-        if field not in config_obj:
-            return '', 409
-    config_path = osp.join(config_dir,
-                           '{}-{}-{}.cfg'.
-                           format(config_obj['name'],
-                                  config_obj['major'],
-                                  config_obj['minor']))
+    try:
+        plan = compile_config(config_obj)
+    except ValueError as e:
+        print('rejected config: {}'.format(e))
+        return '', 409
+    config_path = osp.join(config_dir, plan['file'])
 
-    if not osp.exists(config_path):
+    with config_lock:
+        if plan['file'] in configs:
+            return '', 409
         with open(config_path, 'w') as fp:
             fp.write(request.data.decode('utf-8'))
         unlock(config_path)
-        return '', 200
-    else:
-        return '', 409
+        register_config(plan)
+    refill_warm_pool(plan['file'])
+    return '', 200
 
 
 @app.route('/cfginfo', methods=['GET'])
 def list_config_files():
     """
-    List all configuration files
-    :returns: Return a list of configuration files
+    List all configuration files. ?name=, ?major= and ?minor= filter the
+    list, ?limit= pages it (the response then has the cursor of the next page
+    in "next", passed back as ?cursor=)
+    :returns: Return a list of configuration files, 304 if the If-None-Match
+            etag is still current, 400 on a bad limit
     """
+    etag = '{}-c{}'.format(boot_id, config_generation)
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': '"{}"'.format(etag)}
+    try:
+        limit = page_limit()
+    except ValueError:
+        return '', 400
+    cursor = request.args.get('cursor')
+    with config_lock:
+        etag = '{}-c{}'.format(boot_id, config_generation)
+        # config_files is sorted, so a cursor is where the last page ended
+        start = bisect.bisect_right(config_files, cursor) if cursor is not None else 0
+        files, more = [], False
+        for config_file in config_files[start:]:
+            if not matches_filters(configs[config_file]['config']):
+                continue
+            if limit is not None and len(files) == limit:
+                more = True
+                break
+            files.append(config_file)
     res = {
-        'files': sorted(os.listdir(config_dir))
+        'files': files
     }
-    return res, 200
+    if limit is not None:
+        res['next'] = files[-1] if more else None
+    return res, 200, {'ETag': '"{}"'.format(etag)}
+
+
+def page_limit():
+    """
+    :return: the ?limit= of a listing, None if it is not paged
+    :raises ValueError: if the limit is not a positive integer
+    """
+    if 'limit' not in request.args:
+        return None
+    limit = int(request.args['limit'])
+    if limit < 1:
+        raise ValueError('bad limit {}'.format(limit))
+    return limit
+
+
+def matches_filters(record):
+    """
+    :param record: an instance record or a config
+    :return: whether the record matches the ?name=, ?major= and ?minor=
+            filters of the request
+    """
+    for field in ['name', 'major', 'minor']:
+        value = request.args.get(field)
+        if value is not None and str(record.get(field)) != value:
+            return False
+    return True
 
 
 @app.route('/launch', methods=['POST'])
 def launch_container():
     """
-    Launch a container
-    :return: Return the instance name and information if launching is
-    success. Return 409 if the configuration file is not existed.
+    Launch a container. With "async": true in the payload (or ?async=1) the
+    launch runs in the background and an operation id is returned at once.
+    With "replicas" or a list of "configs" several instances are launched
+    in one call, see launch_batch
+    :return: Return the instance name and information once the container is
+    ready. Return 409 if the configuration file is not existed, 500 if the
+    container exits during startup and 504 (with the instance information)
+    if it is not ready within the timeout. In async mode return 202 with the
+    operation id.
     """
     create_dir_if_not_exists(container_dir)
     payload = request.get_json(silent=True)
-    if payload is None:
+    if not isinstance(payload, dict):
         return '', 409
+    run_async = payload.get('async') or request.args.get('async') in ('1', 'true')
+    if 'replicas' in payload or 'configs' in payload:
+        return launch_batch(payload, run_async)
     for field in ['name', 'major', 'minor']:
         if field not in payload:
             return '', 409
     config_name = payload['name']
     major = payload['major']
     minor = payload['minor']
-    if not osp.exists(osp.join(config_dir, '{}-{}-{}.cfg'.format(config_name,
-                                                                 major,
-                                                                 minor))):
+    plan = configs.get(config_file_name(config_name, major, minor))
+    if plan is None:
         return '', 409
-    instance_counter.update([config_name])
-    instance_name = '{}_{}'.format(config_name, instance_counter[config_name])
-    res = {
-        'instance': instance_name,
-        'name': config_name,
-        'major': major,
-        'minor': minor,
-    }
-    instances[instance_name] = res
-    # Create floder
+    res = allocate_instance(config_name, major, minor)
+    instance_name = res['instance']
+    if run_async:
+        return {'operation': submit_launch_operation(plan, res), 'instance': instance_name}, 202
+    try:
+        status = start_instance(plan, instance_name)
+    except syscalls.SyscallError as e:
+        return {'error': e.to_dict()}, 500
+    return (res if status != 500 else ''), status
+
+
+def launch_batch(payload, run_async):
+    """
+    Launch several instances in one call: "replicas" copies of the named
+    config, or of each entry of "configs" (each with its own optional
+    "replicas"). Every plan is prepared once for the whole batch and the
+    instances are then started in parallel
+    :param payload: the launch payload
+    :param run_async: start one background operation per instance instead
+    :return: 200 with every instance record (each with its own status), 207
+            if some of them failed, 409 if a config is missing or a replica
+            count is bad; 202 with the operations in async mode
+    """
+    entries = payload.get('configs', [payload])
+    if not isinstance(entries, list) or not entries:
+        return '', 409
+    batch = []
+    for entry in entries:
+        if not isinstance(entry, dict) or any(field not in entry for field in ['name', 'major', 'minor']):
+            return '', 409
+        replicas = entry.get('replicas', payload.get('replicas', 1))
+        if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 1:
+            return '', 409
+        plan = configs.get(config_file_name(entry['name'], entry['major'], entry['minor']))
+        if plan is None:
+            return '', 409
+        batch.append((entry, plan, replicas))
+    if run_async:
+        res = []
+        for entry, plan, replicas in batch:
+            for _ in range(replicas):
+                record = allocate_instance(entry['name'], entry['major'], entry['minor'])
+                res.append({'operation': submit_launch_operation(plan, record),
+                            'instance': record['instance']})
+        return {'operations': res}, 202
+
+    # share mountable extraction and the base image lookup across the batch
+    prepared = {}
+    try:
+        for _, plan, _ in batch:
+            if plan['file'] not in prepared:
+                prepared[plan['file']] = prepare_launch(plan)
+    except syscalls.SyscallError as e:
+        for launch in prepared.values():
+            finish_launch(launch)
+        return {'error': e.to_dict()}, 500
+    launches = []
+    for entry, plan, replicas in batch:
+        for _ in range(replicas):
+            launches.append((plan, allocate_instance(entry['name'], entry['major'], entry['minor'])))
+
+    def launch_one(launch):
+        plan, record = launch
+        # the registered record is what /list shows, report on a copy
+        record = dict(record)
+        try:
+            record['status'] = start_instance(plan, record['instance'], prepared[plan['file']])
+        except syscalls.SyscallError as e:
+            record.update(status=500, error=e.to_dict())
+        return record
+
+    try:
+        res = list(launch_executor.map(launch_one, launches))
+    finally:
+        for launch in prepared.values():
+            finish_launch(launch)
+    status = 200 if all(record['status'] == 200 for record in res) else 207
+    return {'instances': res}, status
+
+
+def submit_launch_operation(plan, res):
+    """
+    Register an async launch and start it in the background
+    :param plan: the config's launch plan
+    :param res: the instance information
+    :return: the operation id
+    """
+    operation_id = uuid.uuid4().hex
+    with operation_lock:
+        operations[operation_id] = {
+            'operation': operation_id,
+            'state': 'pending',
+            'instance': res,
+        }
+        while len(operations) > max_operations:
+            operations.popitem(last=False)
+    launch_executor.submit(run_launch_operation, operation_id, plan, res)
+    return operation_id
+
+
+@app.route('/operations/<operation_id>', methods=['GET'])
+def get_operation(operation_id):
+    """
+    Report the progress of an async launch
+    :param operation_id: the id returned by an async /launch
+    :return: the operation's state (pending, ready, exited, timeout or
+            failed), its instance and the status code the synchronous call
+            would have returned; 404 if the operation is unknown
+    """
+    with operation_lock:
+        if operation_id not in operations:
+            return '', 404
+        return dict(operations[operation_id]), 200
+
+
+def allocate_instance(config_name, major, minor):
+    """
+    Atomically pick the next <name>_<n> instance name and register it
+    :param config_name: the config name
+    :param major: the major version
+    :param minor: the minor version
+    :return: the instance information
+    """
+    with registry_lock:
+        instance_counter.update([config_name])
+        number = node_index + 1 + (instance_counter[config_name] - 1) * node_count
+        res = {
+            'instance': '{}_{}'.format(config_name, number),
+            'name': config_name,
+            'major': major,
+            'minor': minor,
+        }
+        instances[res['instance']] = res
+        touch_instances()
+        instance_seqs[res['instance']] = instance_generation
+    return res
+
+
+def touch_instances():
+    """
+    Bump the instance registry generation, which /list uses as its etag;
+    the caller holds registry_lock
+    :return: None
+    """
+    global instance_generation
+    instance_generation += 1
+
+
+def run_launch_operation(operation_id, plan, res):
+    """
+    Background body of an async launch
+    :param operation_id: the operation id
+    :param plan: the config's launch plan
+    :param res: the instance information
+    :return: None
+    """
+    result = {}
+    try:
+        status = start_instance(plan, res['instance'])
+        result['state'] = {200: 'ready', 504: 'timeout'}.get(status, 'exited')
+    except Exception as e:
+        print('launch of {} failed: {}'.format(res['instance'], e))
+        status, result['state'] = 500, 'failed'
+        if isinstance(e, syscalls.SyscallError):
+            result['error'] = e.to_dict()
+    with operation_lock:
+        if operation_id in operations:
+            operations[operation_id].update(result, status=status)
+
+
+def start_instance(plan, instance_name, prepared=None):
+    """
+    Bring up an instance, recording how long the launch took and how it
+    ended
+    :param plan: the config's launch plan
+    :param instance_name: the allocated instance name
+    :param prepared: the batch's prepare_launch result, if any
+    :return: the http status code of the launch
+    """
+    start = time.perf_counter()
+    result = 'failed'
+    try:
+        with operations_in_flight.track(kind='launch'):
+            status = boot_instance(plan, instance_name, prepared)
+        result = launch_results.get(status, 'failed')
+        return status
+    finally:
+        launch_seconds.observe(time.perf_counter() - start, result=result)
+        launches_total.inc(config=plan['file'], result=result)
+
+
+def boot_instance(plan, instance_name, prepared=None):
+    """
+    Provision an instance, start its startup script and wait until it is
+    ready
+    :param plan: the config's launch plan
+    :param instance_name: the allocated instance name
+    :param prepared: the batch's prepare_launch result, if any
+    :return: the http status code of the launch
+    """
     instance_dir = osp.join(container_dir, instance_name)
-    os.makedirs(instance_dir)
-    unlock(instance_dir)
-    # Untar the basic image
-    os.system('tar -zxf base_images/basefs.tar.gz -C {}'.format(instance_dir))
-    image_dir = osp.join(instance_dir, 'basefs')
-    with open(osp.join(config_dir, '{}-{}-{}.cfg'.format(config_name,
-                                                         major,
-                                                         minor))) as fp:
-        config_obj = json.load(fp)
-    # Mount
+    # Take a pre-provisioned root from the warm pool, or build one now
+    with launch_phase_seconds.time(phase='warm_claim'):
+        warm_root = claim_warm_root(plan)
+    cgroup_dir = None
+    try:
+        if warm_root is not None:
+            os.rename(warm_root, instance_dir)
+            mountable_users[instance_dir] = mountable_users.pop(warm_root, [])
+            image_dir = osp.join(instance_dir, 'basefs')
+        else:
+            image_dir = provision_instance(plan, instance_dir, prepared)
+        with launch_phase_seconds.time(phase='cgroup'):
+            cgroup_dir = cgroups.create(instance_name, plan['resources'])
+        # Create child process and start instance
+        with launch_phase_seconds.time(phase='spawn'):
+            container_process = start_container(image_dir, plan, cgroup_dir)
+    except Exception:
+        with registry_lock:
+            instances.pop(instance_name, None)
+            instance_seqs.pop(instance_name, None)
+            touch_instances()
+        if osp.exists(instance_dir):
+            release_instance(plan, instance_dir)
+        if cgroup_dir is not None:
+            remove_cgroup(cgroup_dir)
+        raise
+    finally:
+        refill_warm_pool(plan['file'])
+    try:
+        watch_container(instance_name, container_process)
+        with registry_lock:
+            destroyed = instance_name not in instances
+            if not destroyed:
+                container_dict[instance_name] = container_process
+                container_cgroups[instance_name] = cgroup_dir
+                touch_instances()
+                capture_logs(instance_name, instance_dir)
+        if not destroyed:
+            journal_start(instance_name, container_process, cgroup_dir)
+            emit_event('launched', instance_name, pid=container_process.pid)
+            start_stats_sampler()
+            if plan['hibernate_after'] > 0:
+                start_hibernation()
+            with launch_phase_seconds.time(phase='readiness'):
+                state = wait_until_ready(container_process, image_dir, plan)
+    except Exception:
+        # never leave a running container nobody supervises or tears down
+        with registry_lock:
+            registered = container_dict.get(instance_name) is container_process
+        teardown_container(instance_name)
+        if not registered:
+            kill_container(container_process, cgroup_dir)
+            release_instance(plan, instance_dir)
+            remove_cgroup(cgroup_dir)
+        raise
+    if destroyed:
+        # destroyed while it was being provisioned, finish the teardown here
+        kill_container(container_process, cgroup_dir)
+        release_instance(plan, instance_dir)
+        remove_cgroup(cgroup_dir)
+        return 404
+    if state == 'ready':
+        emit_event('ready', instance_name)
+    if state == 'exited':
+        teardown_container(instance_name)
+        return 500
+    supervise(instance_name, container_process)
+    return 200 if state == 'ready' else 504
+
+
+def config_file_name(name, major, minor):
+    """
+    :param name: the config name
+    :param major: the major version
+    :param minor: the minor version
+    :return: the config's file name
+    """
+    return '{}-{}-{}.cfg'.format(name, major, minor)
+
+
+def compile_config(config_obj):
+    """
+    Validate a config and precompute everything a launch or teardown needs:
+    the base tarball and the layers of a committed base image, resolved mount sources and targets
+    in parent-before-child order, the normalized environment and the
+    readiness probe
+    :param config_obj: config object
+    :return: the launch plan
+    :raises ValueError: if the config is invalid
+    """
+    if not isinstance(config_obj, dict):
+        raise ValueError('config is not an object')
+    for field in ['name', 'major', 'minor', 'base_image',
+                  'mounts', 'startup_script', 'startup_owner',
+                  'startup_env']:
+        if field not in config_obj:
+            raise ValueError('missing {}'.format(field))
+    # they name the config file, the instance directories and the cgroups
+    for field in ['name', 'major', 'minor']:
+        value = config_obj[field]
+        if isinstance(value, bool) or not isinstance(value, (str, int)) or str(value) in ('', '.') or \
+                '/' in str(value) or '..' in str(value) or '\0' in str(value):
+            raise ValueError('bad {} {!r}'.format(field, value))
+    if not isinstance(config_obj['mounts'], list):
+        raise ValueError('mounts is not a list')
+    if not isinstance(config_obj['startup_env'], str):
+        raise ValueError('startup_env is not a string')
+    warm_pool = config_obj.get('warm_pool', warm_pool_size)
+    if not isinstance(warm_pool, int) or warm_pool < 0:
+        raise ValueError('bad warm_pool {!r}'.format(warm_pool))
+    hibernate_after = config_obj.get('hibernate_after', hibernate_delay)
+    if isinstance(hibernate_after, bool) or not isinstance(hibernate_after, (int, float)) or hibernate_after < 0:
+        raise ValueError('bad hibernate_after {!r}'.format(hibernate_after))
+    auto_thaw = config_obj.get('auto_thaw', True)
+    if not isinstance(auto_thaw, bool):
+        raise ValueError('bad auto_thaw {!r}'.format(auto_thaw))
+    readiness = config_obj.get('readiness', {})
+    if not isinstance(readiness, dict):
+        raise ValueError('readiness is not an object')
+    port = readiness.get('port')
+    if port is not None and (isinstance(port, bool) or not isinstance(port, int) or not 0 <= port <= 65535):
+        raise ValueError('bad readiness port {!r}'.format(port))
+    if not isinstance(readiness.get('file', ''), str):
+        raise ValueError('bad readiness file {!r}'.format(readiness['file']))
+    timeout = readiness.get('timeout', launch_timeout)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or \
+            not math.isfinite(timeout) or timeout <= 0:
+        raise ValueError('bad readiness timeout {!r}'.format(timeout))
+    resources = compile_resources(config_obj.get('resources', {}))
+    restart = compile_restart(config_obj.get('restart', 'never'))
+    if not isinstance(config_obj['base_image'], str):
+        raise ValueError('base_image is not a string')
+    # a committed image is its layers, top first, on top of the base tarball
+    image = committed_image(config_obj['base_image'])
+    layers = image['layers'] if image is not None else []
+    base = image['base'] if image is not None else config_obj['base_image']
+    if not valid_tarball_name(base) or \
+            (not osp.isfile(osp.join(base_images_dir, base)) and image_manifest(base) is None):
+        raise ValueError('unknown base_image {!r}'.format(config_obj['base_image']))
+
+    mounts = []
     for mount_argv in config_obj['mounts']:
-        execute_mount(mount_argv, image_dir)
-    os.system('mount -t proc proc {}'.format(osp.join(image_dir, 'proc')))
-    # Create child process and start instance
-    container_process = Process(target=start_container, args=(image_dir, config_obj))
-    container_dict[instance_name] = container_process
-    container_process.start()
-    # Set group id
-    os.setpgid(container_process.pid, container_process.pid)
-    time.sleep(3)
+        fields = mount_argv.split() if isinstance(mount_argv, str) else []
+        if len(fields) != 3:
+            raise ValueError('bad mount {!r}'.format(mount_argv))
+        filename, target, access = fields
+        if access not in ('READ', 'READWRITE'):
+            raise ValueError('bad access {!r}'.format(access))
+        if filename != osp.basename(filename) or not filename.endswith('.tar'):
+            raise ValueError('bad mountable {!r}'.format(filename))
+        target = posixpath.normpath('/' + target).lstrip('/')
+        if target in ('', 'proc') or target.startswith('proc/') or \
+                target in [mount['target'] for mount in mounts]:
+            raise ValueError('bad mount point {!r}'.format(fields[1]))
+        mounts.append({
+            'tar': osp.join(mountables_dir, filename),
+            'top_dir': filename.split('.')[0],
+            'target': target,
+            'readonly': access == 'READ',
+        })
+    # parents before children, so nested mounts land on top of their parent
+    mounts.sort(key=lambda mount: (mount['target'].count('/'), mount['target']))
+
+    env = [assignment.strip() for assignment in config_obj['startup_env'].split(';')]
+    env = [assignment for assignment in env if assignment]
+    if port is None:
+        for assignment in env:
+            key, _, value = assignment.partition('=')
+            if key == 'PORT' and value.strip().isdigit() and int(value) <= 65535:
+                port = int(value)
+    return {
+        'file': config_file_name(config_obj['name'], config_obj['major'], config_obj['minor']),
+        'config': config_obj,
+        'mounts': mounts,
+        'base': base,
+        'layers': layers,
+        'env': ''.join(assignment + ';' for assignment in env),
+        'port': port or None,
+        'ready_file': readiness.get('file'),
+        'timeout': timeout,
+        'warm_pool': warm_pool,
+        'resources': resources,
+        'hibernate_after': hibernate_after,
+        'auto_thaw': auto_thaw,
+        'restart': restart,
+    }
+
+
+def compile_resources(resources):
+    """
+    Translate the resources of a config into cgroup v2 control file values
+    :param resources: cpu_weight and io_weight (1-10000), cpu_max (a number
+            of CPUs), memory_max (bytes, or with a K, M or G suffix) and
+            pids_max, all optional
+    :return: control file name to value
+    :raises ValueError: if a resource is unknown or out of range
+    """
+    if not isinstance(resources, dict):
+        raise ValueError('resources is not an object')
+    res = {}
+    for key, value in resources.items():
+        # json.loads takes NaN and Infinity
+        if isinstance(value, bool) or (isinstance(value, float) and not math.isfinite(value)):
+            raise ValueError('bad {} {!r}'.format(key, value))
+        if key in ('cpu_weight', 'io_weight'):
+            if not isinstance(value, int) or not 1 <= value <= 10000:
+                raise ValueError('bad {} {!r}'.format(key, value))
+            res['cpu.weight' if key == 'cpu_weight' else 'io.weight'] = \
+                str(value) if key == 'cpu_weight' else 'default {}'.format(value)
+        elif key == 'pids_max':
+            if not isinstance(value, int) or value < 1:
+                raise ValueError('bad pids_max {!r}'.format(value))
+            res['pids.max'] = str(value)
+        elif key == 'cpu_max':
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError('bad cpu_max {!r}'.format(value))
+            # a quota per 100ms period
+            res['cpu.max'] = '{} 100000'.format(max(1000, int(value * 100000)))
+        elif key == 'memory_max':
+            units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+            text = str(value).strip().upper()
+            number, unit = (text[:-1], units[text[-1]]) if text[-1:] in units else (text, 1)
+            if not number.isdigit() or int(number) == 0:
+                raise ValueError('bad memory_max {!r}'.format(value))
+            res['memory.max'] = str(int(number) * unit)
+        else:
+            raise ValueError('unknown resource {!r}'.format(key))
+    return res
+
+
+def compile_restart(restart):
+    """
+    Validate the restart policy of a config: a policy name, or an object
+    with the policy, the most restarts in a row, the delay before the
+    second restart in a row (it doubles with each one after, the first is
+    immediate) and the longest delay
+    :param restart: the config's restart
+    :return: the policy, max_restarts (None for no limit), backoff and
+            max_backoff
+    :raises ValueError: on an unknown policy or a bad number
+    """
+    if isinstance(restart, str):
+        restart = {'policy': restart}
+    if not isinstance(restart, dict):
+        raise ValueError('restart is not an object')
+    res = {'policy': 'never', 'max_restarts': 10, 'backoff': 0.1, 'max_backoff': 30}
+    for key, value in restart.items():
+        if key not in res:
+            raise ValueError('unknown restart setting {!r}'.format(key))
+        if key == 'policy' and value not in ('never', 'on-failure', 'always'):
+            raise ValueError('bad restart policy {!r}'.format(value))
+        if key == 'max_restarts' and value is not None and \
+                (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+            raise ValueError('bad max_restarts {!r}'.format(value))
+        if key in ('backoff', 'max_backoff') and \
+                (isinstance(value, bool) or not isinstance(value, (int, float)) or
+                 not math.isfinite(value) or value < 0):
+            raise ValueError('bad {} {!r}'.format(key, value))
+        res[key] = value
+    return res
+
+
+def register_config(plan):
+    """
+    Add a compiled config to the in-memory registry; the caller holds
+    config_lock
+    :param plan: the launch plan
+    :return: None
+    """
+    global config_generation
+    configs[plan['file']] = plan
+    bisect.insort(config_files, plan['file'])
+    config_generation += 1
+
+
+def load_configs():
+    """
+    Compile every config file on disk into the registry
+    :return: None
+    """
+    with config_lock:
+        for config_file in os.listdir(config_dir):
+            try:
+                with open(osp.join(config_dir, config_file)) as fp:
+                    register_config(compile_config(json.load(fp)))
+            except ValueError as e:
+                print('skipping config {}: {}'.format(config_file, e))
+
+
+def wait_until_ready(container_process, image_dir, plan):
+    """
+    Poll a freshly started container until its startup process has stayed
+    alive for the settle time, the configured port accepts connections and
+    the configured file exists
+    :param container_process: the container's process
+    :param image_dir: container's image directory
+    :param plan: the config's launch plan
+    :return: 'ready', 'exited' if the startup process died or 'timeout'
+    """
+    port, ready_file = plan['port'], plan['ready_file']
+    if ready_file is not None:
+        # look through the container's mount namespace, the file may be in a mountable
+        ready_file = '/proc/{}/root{}/{}'.format(container_process.pid, image_dir, ready_file.lstrip('/'))
+    settled = time.time() + launch_settle
+    deadline = time.time() + plan['timeout']
+    delay = 0.01
+    while True:
+        if container_process.poll() is not None:
+            return 'exited'
+        ready = time.time() >= settled
+        ready = ready and (ready_file is None or osp.exists(ready_file))
+        if ready and port is not None:
+            try:
+                socket.create_connection(('localhost', port), timeout=0.1).close()
+            except OSError:
+                ready = False
+        if ready:
+            return 'ready'
+        if time.time() >= deadline:
+            return 'timeout'
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
+@app.route('/events', methods=['GET'])
+def stream_events():
+    """
+    Stream instance lifecycle events (launched, ready, exited, destroyed) as
+    server-sent events. A reconnecting client sends the last id it saw in
+    Last-Event-ID (or ?since=) and gets the missed events replayed from the
+    buffer, or a resync event when they are no longer buffered. The stream
+    ends after STREAM_WINDOW seconds and the client reconnects
+    :return: a text/event-stream response, 400 on a bad event id, 503 when
+            MAX_STREAMS streams are open
+    """
+    try:
+        last_id = int(request.headers.get('Last-Event-ID', request.args.get('since', -1)))
+    except ValueError:
+        return '', 400
+    if last_id < 0:
+        # a new client only gets what happens from now on
+        with event_condition:
+            last_id = event_counter
+    return open_stream(event_stream(last_id), mimetype='text/event-stream')
+
+
+def open_stream(chunks, **kwargs):
+    """
+    Start a streamed response if fewer than MAX_STREAMS are open, so that
+    streams can never take every server thread
+    :param chunks: the generator of the response's chunks
+    :param kwargs: more Response arguments
+    :return: the response, 503 if too many streams are open
+    """
+    global open_streams
+    with stream_lock:
+        if open_streams >= max_streams:
+            chunks.close()
+            return '', 503, {'Retry-After': str(event_keepalive)}
+        open_streams += 1
+    response = Response(chunks, headers=dict({'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+                                             **kwargs.pop('headers', {})), **kwargs)
+    response.call_on_close(close_stream)
+    return response
+
+
+def close_stream():
+    """
+    Give back the slot of a stream that ended or whose client went away
+    :return: None
+    """
+    global open_streams
+    with stream_lock:
+        open_streams -= 1
+
+
+def event_stream(last_id):
+    """
+    Generate the server-sent events after an event id, for STREAM_WINDOW
+    seconds
+    :param last_id: the id of the last event the client has seen
+    :return: a generator of text/event-stream chunks
+    """
+    deadline = time.time() + stream_window
+    while time.time() < deadline:
+        with event_condition:
+            if not events or events[-1]['id'] <= last_id:
+                event_condition.wait(min(event_keepalive, max(deadline - time.time(), 0)))
+            first_id = events[0]['id'] if events else event_counter + 1
+            lost = last_id + 1 < first_id or last_id > event_counter
+            pending = [event for event in events if event['id'] > last_id]
+            current_id = event_counter
+        if lost:
+            # the events the client missed are gone, it has to resync
+            yield 'id: {}\nevent: resync\ndata: {{}}\n\n'.format(current_id)
+            last_id = current_id
+            continue
+        if not pending:
+            # keeps proxies from timing out and notices gone clients
+            yield ': keepalive\n\n'
+        for event in pending:
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['event'],
+                                                            json.dumps(event))
+            last_id = event['id']
+
+
+def emit_event(kind, instance_name, **fields):
+    """
+    Record a lifecycle event and wake up the event streams
+    :param kind: launched, ready, exited, restarting, restarted, destroyed,
+            committed, frozen or thawed
+    :param instance_name: the instance name
+    :param fields: extra event fields, like the exit code
+    :return: None
+    """
+    global event_counter
+    with event_condition:
+        event_counter += 1
+        event = {'id': event_counter, 'event': kind, 'instance': instance_name, 'time': time.time()}
+        event.update(fields)
+        events.append(event)
+        event_condition.notify_all()
+
+
+@app.route('/pool', methods=['GET'])
+def list_warm_pools():
+    """
+    helper function, report the warm pool of every config that has one
+    :return: a http response body with the size, target and hit, miss and
+                refill counters of each config's warm pool
+    """
+    res = {}
+    with warm_pool_lock:
+        for config_file, stats in warm_pool_stats.items():
+            if configs[config_file]['warm_pool'] == 0:
+                continue
+            res[config_file] = {
+                'size': len(warm_pools.get(config_file, [])),
+                'target': configs[config_file]['warm_pool'],
+                'hits': stats['hits'],
+                'misses': stats['misses'],
+                'refills': stats['refills'],
+                'refill_seconds_total': stats['refill_seconds'],
+                'last_refill_seconds': stats['last_refill_seconds'],
+            }
     return res, 200
 
 
 @app.route('/list', methods=['GET'])
 def list_instances():
     """
-    List all running instances
-    :return: A list of running instances
+    List all running instances. ?name=, ?major=, ?minor= and ?state=
+    (starting, running, frozen, restarting or exited; exited instances are
+    only listed when asked for) filter the list, ?limit= pages it (the response
+    then has the cursor of the next page in "next", passed back as ?cursor=)
+    :return: A list of running instances, 304 if the If-None-Match etag is
+            still current, 400 on a bad limit or cursor
     """
+    etag = '{}-i{}'.format(boot_id, instance_generation)
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': '"{}"'.format(etag)}
+    try:
+        limit = page_limit()
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError:
+        return '', 400
+    state = request.args.get('state')
+    page, more = [], False
+    with registry_lock:
+        etag = '{}-i{}'.format(boot_id, instance_generation)
+        # instances are in allocation order, which is also instance_seqs order
+        for instance_name, record in instances.items():
+            if instance_seqs[instance_name] <= cursor:
+                continue
+            if state is not None and state != instance_state(instance_name):
+                continue
+            if state is None and instance_name in exited_instances:
+                continue
+            if not matches_filters(record):
+                continue
+            if limit is not None and len(page) == limit:
+                more = True
+                break
+            page.append(record)
+        next_cursor = instance_seqs[page[-1]['instance']] if more else None
     res = {
-        'instances': list(instances.values())
+        'instances': page
     }
-    return res, 200
+    if limit is not None:
+        res['next'] = str(next_cursor) if next_cursor is not None else None
+    return res, 200, {'ETag': '"{}"'.format(etag)}
+
+
+def instance_state(instance_name):
+    """
+    :param instance_name: a registered instance; the caller holds registry_lock
+    :return: 'exited' once its container exited for good, 'restarting'
+            until its restart policy restarts it, 'frozen' while hibernated,
+            'running' once its container is started, else 'starting'
+    """
+    if instance_name in exited_instances:
+        return 'exited'
+    if instance_name in restarting_instances:
+        return 'restarting'
+    if instance_name in frozen_instances:
+        return 'frozen'
+    return 'running' if instance_name in container_dict else 'starting'
+
+
+@app.route('/instances/<instance_name>/stats', methods=['GET'])
+def get_instance_stats(instance_name):
+    """
+    Report the latest resource usage sample of a running instance
+    :param instance_name: the instance name
+    :return: cpu seconds and percent, resident memory, process count and
+            io bytes as of the sample time; 404 if the instance is not
+            running or not sampled yet
+    """
+    with stats_lock:
+        sample = instance_stats.get(instance_name)
+    if sample is None:
+        return '', 404
+    return sample, 200
+
+
+@app.route('/instances/stats', methods=['GET'])
+def get_aggregate_stats():
+    """
+    Report the latest resource usage of all running instances together
+    :return: the sums over every sampled instance, and the sample of each
+    """
+    with stats_lock:
+        samples = dict(instance_stats)
+    total = {'instances': len(samples)}
+    for field in ['cpu_seconds', 'cpu_percent', 'rss_bytes', 'processes',
+                  'io_read_bytes', 'io_write_bytes']:
+        total[field] = sum(sample[field] or 0 for sample in samples.values())
+    return {'total': total, 'instances': samples}, 200
+
+
+@app.route('/instances/<instance_name>/logs', methods=['GET'])
+def get_instance_logs(instance_name):
+    """
+    An instance's output, stdout and stderr together, from its in-memory
+    buffer: the last LOG_BUFFER_BYTES of it, its last ?tail= lines, or what
+    follows the byte offset ?since=. X-Log-Offset is the offset of the first
+    byte sent. With ?follow=1 the response stays open and streams the new
+    output as it comes, until the instance is destroyed or for STREAM_WINDOW
+    seconds, after which the client resumes with ?since=
+    :param instance_name: the instance name
+    :return: text/plain; 400 on a bad tail or since, 404 if the instance has
+            no captured output, 503 when MAX_STREAMS streams are open
+    """
+    try:
+        tail = int(request.args['tail']) if 'tail' in request.args else None
+        since = int(request.args['since']) if 'since' in request.args else None
+    except ValueError:
+        return '', 400
+    if (tail is not None and tail < 0) or (since is not None and since < 0):
+        return '', 400
+    with log_lock:
+        log = instance_logs.get(instance_name)
+    if log is None:
+        return '', 404
+    offset = log.tail_offset(tail) if since is None else min(max(since, log.start), log.end)
+    if request.args.get('follow', '0') in ('0', 'false', ''):
+        chunk, _ = log.read(offset)
+        return Response(chunk, mimetype='text/plain', headers={'X-Log-Offset': str(offset)})
+    return open_stream(log_stream(log, offset), mimetype='text/plain', headers={'X-Log-Offset': str(offset)})
+
+
+def log_stream(log, offset):
+    """
+    Generate an instance's output from an offset on, until its log is closed
+    or for STREAM_WINDOW seconds
+    :param log: the instance's LogBuffer
+    :param offset: the offset to start at
+    :return: a generator of output chunks
+    """
+    deadline = time.time() + stream_window
+    while time.time() < deadline:
+        chunk, offset = log.read(offset)
+        if chunk:
+            yield chunk
+        elif not log.wait(offset, min(event_keepalive, max(deadline - time.time(), 0))):
+            return
+
+
+def capture_logs(instance_name, instance_dir):
+    """
+    Start draining an instance's console FIFO into its log buffer, once per
+    instance: a restarted container writes to the same FIFO
+    :param instance_name: the instance name
+    :param instance_dir: the instance's directory
+    :return: None
+    """
+    global log_thread
+    with log_lock:
+        if instance_name in instance_logs:
+            return
+        try:
+            # read-write, so the FIFO never reads as closed between restarts
+            fd = os.open(osp.join(instance_dir, 'console'), os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+        except FileNotFoundError:
+            # started by a manager that did not capture output
+            return
+        if log_thread is None:
+            log_selector.register(log_wakeup[0], selectors.EVENT_READ)
+            log_thread = threading.Thread(target=log_collector, daemon=True)
+            log_thread.start()
+        instance_logs[instance_name] = logs.LogBuffer(
+            log_buffer_bytes, osp.join(log_dir, instance_name + '.log') if log_file_bytes > 0 else None,
+            log_file_bytes, log_files)
+        log_fds[instance_name] = fd
+        log_selector.register(fd, selectors.EVENT_READ, instance_logs[instance_name])
+
+
+def release_logs(instance_name):
+    """
+    Stop capturing a destroyed instance's output and delete its log files
+    :param instance_name: the instance name
+    :return: None
+    """
+    with log_lock:
+        log = instance_logs.pop(instance_name, None)
+        fd = log_fds.pop(instance_name, None)
+        if fd is not None:
+            log_closing.append(fd)
+    if log is None:
+        return
+    log.close(remove_files=True)
+    os.write(log_wakeup[1], b'x')
+
+
+def log_collector():
+    """
+    Background thread copying what every container writes into its log
+    buffer, as soon as it is written. The console FIFOs of released
+    instances are closed here, between two selects, so a descriptor is never
+    closed while it may still be read
+    :return: None
+    """
+    while True:
+        for key, _ in log_selector.select():
+            if key.fd == log_wakeup[0]:
+                os.read(log_wakeup[0], 4096)
+                continue
+            try:
+                data = os.read(key.fd, 1 << 16)
+            except BlockingIOError:
+                continue
+            try:
+                key.data.write(data)
+            except OSError as e:
+                print('logs: {}'.format(e))
+        with log_lock:
+            for fd in log_closing:
+                log_selector.unregister(fd)
+                os.close(fd)
+            log_closing.clear()
+
+
+@app.route('/instances/<instance_name>/commit', methods=['POST'])
+def commit_instance(instance_name):
+    """
+    Save what a running instance changed in its root filesystem as a new
+    image, which configs can then name as their base_image. The image is
+    one new layer holding only the changes, on top of the layers of the
+    instance's own image, so descendants share their ancestors' layers.
+    Mountables are not part of the image
+    :param instance_name: the instance name
+    :return: the image's manifest; 404 if the instance is not running, 409
+            if the image name is bad or taken, the instance has no overlay
+            root or its image already has max_image_layers layers
+    """
+    payload = request.get_json(silent=True)
+    image_name = payload.get('image') if isinstance(payload, dict) else None
+    if not isinstance(image_name, str) or not valid_image_name(image_name):
+        return '', 409
+    with registry_lock:
+        instance_info = instances.get(instance_name)
+        container_process = container_dict.get(instance_name)
+        cgroup_dir = container_cgroups.get(instance_name)
+        frozen = instance_name in frozen_instances
+    if container_process is None:
+        return '', 404
+    plan = configs[config_file_name(instance_info['name'],
+                                    instance_info['major'],
+                                    instance_info['minor'])]
+    instance_dir = osp.join(container_dir, instance_name)
+    if len(plan['layers']) >= max_image_layers or not osp.ismount(osp.join(instance_dir, 'basefs')):
+        return '', 409
+    with image_lock:
+        if image_name in image_commits or committed_image(image_name) is not None:
+            return '', 409
+        image_commits.add(image_name)
+    try:
+        manifest = commit_layer(image_name, plan, instance_dir, container_process, cgroup_dir, frozen)
+    except syscalls.SyscallError as e:
+        return {'error': e.to_dict()}, 500
+    finally:
+        with image_lock:
+            image_commits.discard(image_name)
+    emit_event('committed', instance_name, image=image_name)
+    return manifest, 200
+
+
+@app.route('/images', methods=['GET'])
+def list_images():
+    """
+    List the images: the imported base images, the tarballs in base_images
+    not imported yet (with "imported" null) and the committed images
+    :return: the images' manifests, by name, each with the config files and
+            committed images that use it
+    """
+    manifests = image_manifests()
+    imported = {manifest['image'] for manifest in manifests}
+    if osp.exists(base_images_dir):
+        manifests += [{'image': file_name, 'kind': 'tarball', 'imported': None}
+                      for file_name in os.listdir(base_images_dir)
+                      if valid_tarball_name(file_name) and file_name not in imported]
+    manifests.sort(key=lambda manifest: manifest['image'])
+    return {'images': [dict(manifest, **image_users(manifest['image'], manifest['kind']))
+                       for manifest in manifests]}, 200
+
+
+@app.route('/images', methods=['POST'])
+def import_base_image():
+    """
+    Import a tarball of base_images into the image store now rather than at
+    the first launch that needs it
+    :return: the image's manifest; 404 if there is no such tarball, 409 if
+            the name is not a plain tarball name, 500 if it cannot be
+            extracted
+    """
+    payload = request.get_json(silent=True)
+    image_name = payload.get('image') if isinstance(payload, dict) else None
+    if not isinstance(image_name, str) or not valid_tarball_name(image_name):
+        return '', 409
+    if not osp.isfile(osp.join(base_images_dir, image_name)):
+        return '', 404
+    try:
+        import_image(image_name)
+    except syscalls.SyscallError as e:
+        return {'error': e.to_dict()}, 500
+    return image_manifest(image_name), 200
+
+
+@app.route('/images/<image_name>', methods=['DELETE'])
+def delete_image(image_name):
+    """
+    Delete an image from the store. A committed image takes along its layers
+    no other committed image shares. An imported base image takes along the
+    files no other image links; its tarball stays in base_images, so it can
+    be imported again
+    :param image_name: the image name
+    :return: the bytes freed; 404 if there is no such image, 409 with the
+            users if a config or committed image uses it
+    """
+    removed = []
+    with image_lock:
+        manifest = image_manifest(image_name)
+        if manifest is None:
+            return '', 404
+        kind = manifest.get('kind', 'committed')
+        users = image_users(image_name, kind)
+        if users['configs'] or users['images']:
+            return users, 409
+        os.unlink(osp.join(image_manifest_dir, image_name + '.json'))
+        image_roots.pop(image_name, None)
+        others = image_manifests()
+        if kind == 'committed':
+            kept = {layer for other in others if other['kind'] == 'committed' for layer in other['layers']}
+            removed = [osp.join(layer_dir, layer) for layer in manifest['layers'] if layer not in kept]
+        elif manifest['digest'] not in [other.get('digest') for other in others]:
+            entry_path = osp.join(image_cache_dir, manifest['digest'])
+            with store_key_lock(entry_path):
+                if osp.exists(entry_path):
+                    deleted_path = '{}.tmp-deleted-{}'.format(entry_path, uuid.uuid4().hex[:8])
+                    os.rename(entry_path, deleted_path)
+                    removed.append(deleted_path)
+    freed = 0
+    for path in removed:
+        freed += dir_size(path) if kind == 'committed' else 0
+        syscalls.rmtree(path)
+    freed += collect_image_objects()
+    return {'image': image_name, 'freed_bytes': freed}, 200
+
+
+def image_manifests():
+    """
+    :return: the manifest of every committed and imported image
+    """
+    res = []
+    if osp.exists(image_manifest_dir):
+        for file_name in os.listdir(image_manifest_dir):
+            manifest = image_manifest(file_name[:-len('.json')]) if file_name.endswith('.json') else None
+            if manifest is not None:
+                res.append(dict(manifest, kind=manifest.get('kind', 'committed')))
+    return res
+
+
+def image_users(image_name, kind):
+    """
+    :param image_name: an image name
+    :param kind: 'tarball' for a base image, 'committed' for a committed one
+    :return: the config files starting from the image, and for a base image
+            the committed images on top of it
+    """
+    with config_lock:
+        config_files = sorted(plan['file'] for plan in configs.values()
+                              if plan['config']['base_image'] == image_name
+                              or (kind == 'tarball' and plan['base'] == image_name))
+    images = []
+    if kind == 'tarball':
+        images = sorted(manifest['image'] for manifest in image_manifests()
+                        if manifest['kind'] == 'committed' and manifest['base'] == image_name)
+    return {'configs': config_files, 'images': images}
+
+
+def valid_image_name(image_name):
+    """
+    :param image_name: a committed image name
+    :return: whether it is a plain file name that cannot be mistaken for a
+            base image tarball
+    """
+    return (image_name != '' and not image_name.startswith('.')
+            and all(c.isascii() and (c.isalnum() or c in '-_.') for c in image_name)
+            and not image_name.endswith(('.tar', '.tar.gz', '.tgz')))
+
+
+def valid_tarball_name(image_name):
+    """
+    :param image_name: a base image name
+    :return: whether it is a plain tarball file name
+    """
+    return (image_name != '' and not image_name.startswith('.') and image_name == osp.basename(image_name)
+            and image_name.endswith(('.tar', '.tar.gz', '.tgz')))
+
+
+def image_manifest(image_name):
+    """
+    :param image_name: a committed image or imported base image name
+    :return: the image's manifest, None if there is no such image
+    """
+    if not valid_image_name(image_name) and not valid_tarball_name(image_name):
+        return None
+    try:
+        with open(osp.join(image_manifest_dir, image_name + '.json')) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def committed_image(image_name):
+    """
+    :param image_name: a committed image name
+    :return: the image's manifest, None if there is no such image
+    """
+    if not valid_image_name(image_name):
+        return None
+    return image_manifest(image_name)
+
+
+def write_image_manifest(manifest):
+    """
+    Write an image's manifest atomically
+    :param manifest: the manifest, named by its "image"
+    :return: None
+    """
+    create_dir_if_not_exists(image_manifest_dir)
+    manifest_path = osp.join(image_manifest_dir, manifest['image'] + '.json')
+    with open(manifest_path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def commit_layer(image_name, plan, instance_dir, container_process, cgroup_dir, frozen=False):
+    """
+    Copy an instance's overlay upper directory into a new layer, with the
+    container paused so the copy is consistent, and write the image's
+    manifest. Deleted files are kept as the overlay whiteouts in the copy
+    :param image_name: the new image's name
+    :param plan: the instance's launch plan
+    :param instance_dir: the instance's directory
+    :param container_process: the container's process
+    :param cgroup_dir: the container's cgroup, if any
+    :param frozen: whether the container is hibernated, and stays so
+    :return: the manifest
+    """
+    create_dir_if_not_exists(layer_dir)
+    layer = uuid.uuid4().hex
+    tmp_path = osp.join(layer_dir, layer + '.tmp')
+    syscalls.makedirs(tmp_path)
+    try:
+        if not frozen:
+            pause_container(container_process, cgroup_dir, True)
+        syscalls.run(['cp', '-a', '--reflink=auto', osp.join(instance_dir, 'upper') + '/.', tmp_path])
+    except syscalls.SyscallError:
+        syscalls.rmtree(tmp_path)
+        raise
+    finally:
+        if not frozen:
+            pause_container(container_process, cgroup_dir, False)
+    os.rename(tmp_path, osp.join(layer_dir, layer))
+    manifest = {
+        'image': image_name,
+        'kind': 'committed',
+        'base': plan['base'],
+        'parent': plan['config']['base_image'],
+        'layers': [layer] + plan['layers'],
+        'instance': osp.basename(instance_dir),
+        'created': time.time(),
+        'bytes': dir_size(osp.join(layer_dir, layer)),
+    }
+    write_image_manifest(manifest)
+    return manifest
+
+
+def pause_container(container_process, cgroup_dir, paused):
+    """
+    Stop or resume every process of a container: with the cgroup freezer
+    when it has a cgroup, else by signalling its process group
+    :param container_process: the container's process
+    :param cgroup_dir: the container's cgroup, if any
+    :param paused: True to stop, False to resume
+    :return: None
+    """
+    if cgroup_dir is not None and cgroups.freeze(cgroup_dir, paused):
+        return
+    try:
+        os.killpg(container_process.pid, signal.SIGSTOP if paused else signal.SIGCONT)
+    except ProcessLookupError:
+        pass
+
+
+@app.route('/instances/<instance_name>/freeze', methods=['POST'])
+def freeze_a_running_instance(instance_name):
+    """
+    Hibernate a running instance: stop all of its processes, keeping their
+    memory, until it is thawed
+    :param instance_name: the instance name
+    :return: the instance and its state; 404 if the instance is not running
+    """
+    try:
+        if freeze_instance(instance_name) is None:
+            return '', 404
+    except syscalls.SyscallError as e:
+        return {'error': e.to_dict()}, 500
+    return {'instance': instance_name, 'state': 'frozen'}, 200
+
+
+@app.route('/instances/<instance_name>/thaw', methods=['POST'])
+def thaw_a_frozen_instance(instance_name):
+    """
+    Resume a hibernated instance
+    :param instance_name: the instance name
+    :return: the instance and its state; 404 if the instance is not running
+    """
+    try:
+        if thaw_instance(instance_name) is None:
+            return '', 404
+    except syscalls.SyscallError as e:
+        return {'error': e.to_dict()}, 500
+    return {'instance': instance_name, 'state': 'running'}, 200
+
+
+def freeze_instance(instance_name, reason='request'):
+    """
+    Stop every process of a running instance
+    :param instance_name: the instance name
+    :param reason: why, for the event: request or idle
+    :return: None if the instance is not running, False if it already was
+            frozen, else True
+    """
+    with hibernation_lock:
+        with registry_lock:
+            container_process = container_dict.get(instance_name)
+            cgroup_dir = container_cgroups.get(instance_name)
+            if container_process is None or instance_name in frozen_instances:
+                return None if container_process is None else False
+        pause_container(container_process, cgroup_dir, True)
+        with registry_lock:
+            if instance_name not in container_dict:
+                # destroyed meanwhile
+                return None
+            frozen_instances[instance_name] = time.time()
+            touch_instances()
+    emit_event('frozen', instance_name, reason=reason)
+    start_hibernation()
+    return True
+
+
+def thaw_instance(instance_name, reason='request'):
+    """
+    Resume every process of a frozen instance
+    :param instance_name: the instance name
+    :param reason: why, for the event: request or connection
+    :return: None if the instance is not running, False if it was not
+            frozen, else True
+    """
+    with hibernation_lock:
+        with registry_lock:
+            container_process = container_dict.get(instance_name)
+            cgroup_dir = container_cgroups.get(instance_name)
+            if container_process is None or instance_name not in frozen_instances:
+                return None if container_process is None else False
+        pause_container(container_process, cgroup_dir, False)
+        with registry_lock:
+            frozen_instances.pop(instance_name, None)
+            # it has to be idle for a whole period again before hibernating
+            idle_since.pop(instance_name, None)
+            touch_instances()
+    emit_event('thawed', instance_name, reason=reason)
+    return True
+
+
+def start_hibernation():
+    """
+    Start the background hibernation thread if it is not running yet
+    :return: None
+    """
+    global hibernation_thread
+    with registry_lock:
+        if hibernation_thread is None:
+            hibernation_thread = threading.Thread(target=hibernator, daemon=True)
+            hibernation_thread.start()
+
+
+def hibernator():
+    """
+    Background thread freezing instances that stayed idle for their config's
+    hibernate_after seconds, and thawing frozen instances with auto_thaw as
+    soon as a connection or data waits on their port. An instance is idle
+    while it uses next to no cpu between stats samples and has no open
+    connection on its port. The kernel completes the handshakes of a frozen
+    server's listening socket, so the waiting connection shows up in its
+    accept queue
+    :return: None
+    """
+    last_cpu = {}
+    while True:
+        time.sleep(hibernation_poll)
+        with registry_lock:
+            running = {instance_name: (configs.get(config_file_name(record['name'], record['major'],
+                                                                    record['minor'])),
+                                       instance_name in frozen_instances)
+                       for instance_name, record in instances.items() if instance_name in container_dict}
+            for instance_name in list(idle_since):
+                if instance_name not in running:
+                    del idle_since[instance_name]
+        ports = {plan['port'] for plan, _ in running.values()
+                 if plan is not None and plan['port'] is not None}
+        waiting, connected = port_activity(ports) if ports else (set(), set())
+        with stats_lock:
+            samples = {instance_name: (sample['time'], sample['cpu_seconds'])
+                       for instance_name, sample in instance_stats.items()}
+        now = time.time()
+        for instance_name, (plan, frozen) in running.items():
+            if plan is None:
+                continue
+            if frozen:
+                if plan['auto_thaw'] and plan['port'] in waiting:
+                    thaw_instance(instance_name, reason='connection')
+                continue
+            if plan['hibernate_after'] <= 0 or instance_name not in samples:
+                continue
+            sample_time, cpu_seconds = samples[instance_name]
+            previous = last_cpu.get(instance_name)
+            busy = False
+            if previous is None or previous[0] != sample_time:
+                busy = previous is None or cpu_seconds - previous[1] > idle_cpu_seconds
+                last_cpu[instance_name] = (sample_time, cpu_seconds)
+            if busy or plan['port'] in connected or plan['port'] in waiting:
+                idle_since[instance_name] = now
+            else:
+                idle_since.setdefault(instance_name, now)
+            if now - idle_since[instance_name] >= plan['hibernate_after']:
+                try:
+                    freeze_instance(instance_name, reason='idle')
+                except syscalls.SyscallError as e:
+                    print('hibernation: {}'.format(e))
+        for instance_name in list(last_cpu):
+            if instance_name not in running:
+                del last_cpu[instance_name]
+
+
+def port_activity(ports):
+    """
+    Look at the host's tcp sockets on some local ports
+    :param ports: the local ports
+    :return: the ports with a connection waiting to be accepted or unread
+            data, and the ports with an established connection
+    """
+    waiting, connected = set(), set()
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as fp:
+                next(fp)
+                for line in fp:
+                    fields = line.split()
+                    port = int(fields[1].rsplit(':', 1)[1], 16)
+                    if port not in ports:
+                        continue
+                    # for a listening socket rx_queue is its accept queue length
+                    if int(fields[4].split(':')[1], 16) > 0:
+                        waiting.add(port)
+                    if fields[3] == '01':
+                        connected.add(port)
+        except FileNotFoundError:
+            continue
+    return waiting, connected
+
+
+def start_stats_sampler():
+    """
+    Start the background stats sampler if it is not running yet
+    :return: None
+    """
+    global stats_thread
+    with stats_lock:
+        if stats_thread is None:
+            stats_thread = threading.Thread(target=stats_sampler, daemon=True)
+            stats_thread.start()
+
+
+def stats_sampler():
+    """
+    Background thread sampling the resource usage of every running
+    instance each STATS_INTERVAL seconds, from its cgroup when it has one,
+    else from /proc for its process group. /proc is scanned at most once a
+    round, however many instances and requests there are
+    :return: None
+    """
+    while True:
+        with registry_lock:
+            running = [(instance_name, process.pid, container_cgroups.get(instance_name))
+                       for instance_name, process in container_dict.items()]
+        process_groups = scan_process_groups() \
+            if any(cgroup_dir is None for _, _, cgroup_dir in running) else {}
+        now = time.time()
+        with stats_lock:
+            previous = dict(instance_stats)
+        samples = {}
+        for instance_name, pid, cgroup_dir in running:
+            if cgroup_dir is not None:
+                pids, usage, source = cgroups.processes(cgroup_dir), cgroups.usage(cgroup_dir), 'cgroup'
+            else:
+                pids, usage, source = process_groups.get(pid, []), {}, 'proc'
+            sample = proc_usage(pids)
+            # cgroup accounting also counts processes that already exited
+            sample.update(usage)
+            last = previous.get(instance_name)
+            cpu_percent = None
+            if last is not None and now > last['time']:
+                cpu_percent = max(0.0, 100 * (sample['cpu_seconds'] - last['cpu_seconds']) / (now - last['time']))
+            sample.update(instance=instance_name, time=now, source=source,
+                          processes=len(pids), cpu_percent=cpu_percent)
+            samples[instance_name] = sample
+        with stats_lock:
+            instance_stats.clear()
+            instance_stats.update(samples)
+        time.sleep(stats_interval)
+
+
+def scan_process_groups():
+    """
+    :return: the pids of every process on the host by process group id
+    """
+    groups = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid)) as fp:
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        groups.setdefault(int(fields[2]), []).append(int(pid))
+    return groups
+
+
+def proc_usage(pids):
+    """
+    Add up the cpu time, resident memory and io of processes from /proc
+    :param pids: the process ids
+    :return: cpu_seconds, rss_bytes, io_read_bytes and io_write_bytes (None
+            when /proc/<pid>/io is not readable)
+    """
+    ticks, page_size = os.sysconf('SC_CLK_TCK'), os.sysconf('SC_PAGE_SIZE')
+    res = {'cpu_seconds': 0.0, 'rss_bytes': 0, 'io_read_bytes': 0, 'io_write_bytes': 0}
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as fp:
+                fields = fp.read().rsplit(')', 1)[1].split()
+            # utime, stime and the times of reaped children
+            res['cpu_seconds'] += sum(int(value) for value in fields[11:15]) / ticks
+            with open('/proc/{}/statm'.format(pid)) as fp:
+                res['rss_bytes'] += int(fp.read().split()[1]) * page_size
+        except (OSError, IndexError):
+            continue
+        try:
+            with open('/proc/{}/io'.format(pid)) as fp:
+                for line in fp:
+                    key, _, value = line.partition(':')
+                    if key in ('read_bytes', 'write_bytes') and res['io_' + key] is not None:
+                        res['io_' + key] += int(value)
+        except OSError:
+            res['io_read_bytes'] = res['io_write_bytes'] = None
+    return res
 
 
 @app.route('/destroy/<instance_name>', methods=['DELETE'])
@@ -152,24 +1734,39 @@ def destroy_a_running_instance(instance_name):
             response status code is 404, else 200
     """
     print('destroy {}'.format(instance_name))
-    if instance_name not in instances:
+    if not teardown_container(instance_name):
         return "", 404
-    teardown_container(instance_name)
     return "", 200
 
 
 @app.route('/destroyall', methods=['DELETE'])
 def destroy_all():
     """
-    destroy all running container instances
+    destroy all running container instances, several at a time
     :return: a http response body with empty body and 200 status code
     """
-    instance_names = copy.copy(list(instances.keys()))
-    for instance_name in instance_names:
-        teardown_container(instance_name)
+    with registry_lock:
+        instance_names = copy.copy(list(instances.keys()))
+    list(teardown_executor.map(teardown_container, instance_names))
     return "", 200
 
 
+@app.route('/reclaim', methods=['GET'])
+def reclaim_status():
+    """
+    helper function, report the container directories still waiting to be
+    deleted after their instances were destroyed
+    :return: a http response body with the pending directories and the number
+                of directories reclaimed so far
+    """
+    with trash_lock:
+        res = {
+            'pending': list(trash_pending.keys()),
+            'reclaimed': trash_counter['reclaimed'],
+        }
+    return res, 200
+
+
 @app.route('/ps', methods=['GET'])
 def ps():
     """
@@ -177,39 +1774,825 @@ def ps():
     :return: a http response body with body contains all a dict listing
                 all running instances' names and their pid
     """
-    return {instance_name: container_dict[instance_name].pid
-            for instance_name in container_dict}, 200
+    with registry_lock:
+        return {instance_name: container_dict[instance_name].pid
+                for instance_name in container_dict}, 200
+
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """
+    helper function, export launch and teardown timings, counters and gauges
+    in the Prometheus text format
+    :return: a http response body with every metric
+    """
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/capacity', methods=['GET'])
+def get_capacity():
+    """
+    Report how loaded this manager is and how much it can take, for a
+    scheduler placing launches over several managers. max_instances comes
+    from MAX_INSTANCES and is advice to the scheduler, it is not enforced
+    here
+    :return: the instances (exited ones left out), the instance limit (None
+            for none), cpus, load average and memory of the host
+    """
+    with registry_lock:
+        instance_count = len(instances) - len(exited_instances)
+    memory = {}
+    with open('/proc/meminfo') as fp:
+        for line in fp:
+            key, _, value = line.partition(':')
+            if key in ('MemTotal', 'MemAvailable'):
+                memory[key] = int(value.split()[0]) * 1024
+    return {
+        'node': node_index,
+        'instances': instance_count,
+        'max_instances': max_instances or None,
+        'configs': len(config_files),
+        'cpus': os.cpu_count(),
+        'load': os.getloadavg()[0],
+        'memory_total_bytes': memory.get('MemTotal'),
+        'memory_available_bytes': memory.get('MemAvailable'),
+    }, 200
+
+
+def use_data_dir(data_dir):
+    """
+    Keep everything this manager writes below another directory, and its
+    containers in a cgroup of their own, so several managers can run on one
+    host. The base image and the mountable tarballs are still read from the
+    manager's own directory
+    :param data_dir: the directory
+    :return: None
+    """
+    global config_dir, container_dir, image_cache_dir, image_object_dir, layer_dir, image_manifest_dir, \
+        mountable_store_dir, warm_dir, trash_dir, state_dir, log_dir, instance_journal
+    data_dir = osp.realpath(data_dir)
+    config_dir = osp.join(data_dir, 'configs')
+    container_dir = osp.join(data_dir, 'containers')
+    image_cache_dir = osp.join(data_dir, 'images')
+    image_object_dir = osp.join(image_cache_dir, '.objects')
+    layer_dir = osp.join(data_dir, 'layers')
+    image_manifest_dir = osp.join(data_dir, 'manifests')
+    mountable_store_dir = osp.join(data_dir, 'store')
+    warm_dir = osp.join(container_dir, '.warm')
+    trash_dir = osp.join(container_dir, '.trash')
+    state_dir = osp.join(data_dir, 'state')
+    log_dir = osp.join(data_dir, 'logs')
+    instance_journal = journal.Journal(state_dir)
+    cgroups.group_name = 'containers-' + hashlib.sha256(data_dir.encode()).hexdigest()[:8]
+
+
+def count_running_instances():
+    """
+    :return: the number of started instances of each config
+    """
+    with registry_lock:
+        config_names = [config_file_name(instances[instance_name]['name'],
+                                         instances[instance_name]['major'],
+                                         instances[instance_name]['minor'])
+                        for instance_name in container_dict]
+    return Counter(config_names)
+
+
+def journal_start(instance_name, container_process, cgroup_dir):
+    """
+    Journal a started container with everything a later run of the manager
+    needs to adopt or clean it up
+    :param instance_name: the instance name
+    :param container_process: the container's process
+    :param cgroup_dir: the container's cgroup, if any
+    :return: None
+    """
+    instance_dir = osp.join(container_dir, instance_name)
+    with registry_lock:
+        record = dict(instances[instance_name])
+        seq = instance_seqs[instance_name]
+        counter = instance_counter[record['name']]
+    instance_journal.append({
+        'op': 'start',
+        'instance': instance_name,
+        'counter': counter,
+        'entry': {
+            'record': record,
+            'seq': seq,
+            'pid': container_process.pid,
+            'start_time': process_start_time(container_process.pid),
+            'cgroup': cgroup_dir,
+            'mountables': mountable_users.get(instance_dir, []),
+        },
+    })
+
+
+def restore_instances():
+    """
+    Reconcile the journaled state with what is still on the host: adopt
+    the containers that are still running, clean up after the dead ones and
+    remove directories, mounts and cgroups nothing accounts for
+    :return: None
+    """
+    state = instance_journal.load()
+    instance_counter.update(state['counter'])
+    adopted, dead = [], []
+    for instance_name, entry in sorted(state['instances'].items(), key=lambda item: item[1]['seq']):
+        start_time = process_start_time(entry['pid'])
+        if start_time is not None and start_time == entry['start_time']:
+            adopted.append((instance_name, entry))
+        else:
+            dead.append((instance_name, entry))
+    for instance_name, entry in adopted:
+        container_process = AdoptedProcess(entry['pid'], entry['start_time'])
+        instance_dir = osp.join(container_dir, instance_name)
+        mountable_users[instance_dir] = []
+        for entry_path in entry['mountables']:
+            if osp.exists(entry_path):
+                pin_mountable(entry_path)
+                mountable_users[instance_dir].append(entry_path)
+        # a hibernated container wakes up, it hibernates again once idle
+        pause_container(container_process, entry['cgroup'], False)
+        with registry_lock:
+            instances[instance_name] = entry['record']
+            container_dict[instance_name] = container_process
+            container_cgroups[instance_name] = entry['cgroup']
+            supervised_instances[instance_name] = time.time()
+            touch_instances()
+            instance_seqs[instance_name] = instance_generation
+        watch_container(instance_name, container_process)
+        capture_logs(instance_name, instance_dir)
+    for instance_name, entry in dead:
+        if entry['cgroup'] is not None and osp.exists(entry['cgroup']):
+            cgroups.kill(entry['cgroup'])
+            remove_cgroup(entry['cgroup'])
+        instance_journal.append({'op': 'destroy', 'instance': instance_name})
+    # whatever is left in containers/ belongs to no running instance
+    if osp.exists(container_dir):
+        for name in os.listdir(container_dir):
+            if name != osp.basename(trash_dir) and name not in instances:
+                path = osp.join(container_dir, name)
+                for mount_path in syscalls.mount_points(path):
+                    detach(mount_path)
+                discard_dir(path)
+    if osp.exists(log_dir):
+        for name in os.listdir(log_dir):
+            if name.rpartition('.log')[0] not in instances:
+                os.unlink(osp.join(log_dir, name))
+    containers_cgroup = cgroups.setup()
+    if containers_cgroup is not None:
+        for name in os.listdir(containers_cgroup):
+            path = osp.join(containers_cgroup, name)
+            if osp.isdir(path) and name not in instances:
+                cgroups.kill(path)
+                remove_cgroup(path)
+    if adopted:
+        start_stats_sampler()
+        start_hibernation()
+    print('restored {} running instances, cleaned up {}'.format(len(adopted), len(dead)))
 
 
 def teardown_container(instance_name):
     """
-    do the cleanup job for destroy a container instance
+    do the cleanup job for destroy a container instance. An instance still
+    being provisioned is only unregistered; its launch finishes the cleanup
     :param instance_name: the name of destroyed container instance
+    :return: False if there was no such instance, else True
+    """
+    with registry_lock:
+        instance_info = instances.pop(instance_name, None)
+        container_process = container_dict.pop(instance_name, None)
+        cgroup_dir = container_cgroups.pop(instance_name, None)
+        frozen_instances.pop(instance_name, None)
+        supervised_instances.pop(instance_name, None)
+        restarting_instances.pop(instance_name, None)
+        restart_counts.pop(instance_name, None)
+        exited_instances.pop(instance_name, None)
+        if instance_info is not None:
+            instance_seqs.pop(instance_name, None)
+            touch_instances()
+    if instance_info is None:
+        return False
+    instance_journal.append({'op': 'destroy', 'instance': instance_name})
+    emit_event('destroyed', instance_name)
+    if container_process is None:
+        # provisioning, or exited for good with its output still captured
+        release_logs(instance_name)
+        return True
+    plan = configs[config_file_name(instance_info['name'],
+                                    instance_info['major'],
+                                    instance_info['minor'])]
+    with operations_in_flight.track(kind='teardown'):
+        with teardown_phase_seconds.time(phase='kill'):
+            kill_container(container_process, cgroup_dir)
+        release_instance(plan, osp.join(container_dir, instance_name))
+        remove_cgroup(cgroup_dir)
+        release_logs(instance_name)
+    teardowns_total.inc(config=plan['file'])
+    return True
+
+
+def kill_container(container_process, cgroup_dir=None):
+    """
+    Kill every process of a container: all of its cgroup when it has one,
+    else its process group
+    :param container_process: the container's process
+    :param cgroup_dir: the container's cgroup, if any
+    :return: None
+    """
+    if cgroup_dir is not None:
+        try:
+            if cgroups.kill(cgroup_dir):
+                return
+        except syscalls.SyscallError as e:
+            print('teardown: {}'.format(e))
+    try:
+        os.killpg(container_process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def remove_cgroup(cgroup_dir):
+    """
+    Remove a killed container's cgroup, logging rather than raising on
+    failure so a teardown always runs to the end
+    :param cgroup_dir: the container's cgroup, or None
+    :return: None
+    """
+    if cgroup_dir is None:
+        return
+    try:
+        with teardown_phase_seconds.time(phase='cgroup'):
+            cgroups.remove(cgroup_dir)
+    except syscalls.SyscallError as e:
+        print('teardown: {}'.format(e))
+
+
+def prepare_launch(plan):
+    """
+    Do the provisioning work every instance of a config shares once: find
+    the extracted base image and extract and pin each mountable
+    :param plan: the config's launch plan
+    :return: the lower directories of the root filesystem and the pinned
+            mountable store entries, in mount order
+    """
+    lower_dirs = image_lower_dirs(plan)
+    entries = []
+    try:
+        for mount in plan['mounts']:
+            entries.append(acquire_mountable(mount['tar']))
+    except syscalls.SyscallError:
+        finish_launch({'entries': entries})
+        raise
+    return {'lower_dirs': lower_dirs, 'entries': entries}
+
+
+def finish_launch(prepared):
+    """
+    Drop the pins prepare_launch took
+    :param prepared: the prepare_launch result
+    :return: None
+    """
+    for entry_path in prepared['entries']:
+        unpin_mountable(entry_path)
+    evict_mountables()
+
+
+def provision_instance(plan, instance_dir, prepared=None):
+    """
+    Build an instance directory ready to start: the root filesystem and the
+    pinned mountables. The mountables and proc are mounted by the container
+    itself, in its own mount namespace
+    :param plan: the config's launch plan
+    :param instance_dir: the instance's directory
+    :param prepared: a prepare_launch result to reuse, None to do it here
+    :return: the path of the instance's root directory
+    """
+    with launch_phase_seconds.time(phase='mkdir'):
+        create_dir_if_not_exists(instance_dir)
+    # Layer the instance root on top of the shared image layers
+    if prepared is not None:
+        lower_dirs = prepared['lower_dirs']
+    else:
+        lower_dirs = image_lower_dirs(plan)
+    with launch_phase_seconds.time(phase='rootfs'):
+        image_dir = provision_rootfs(lower_dirs, instance_dir)
+    mountable_users[instance_dir] = []
+    for index, mount in enumerate(plan['mounts']):
+        with launch_phase_seconds.time(phase='mount'):
+            if prepared is not None:
+                entry_path = prepared['entries'][index]
+                pin_mountable(entry_path)
+            else:
+                entry_path = acquire_mountable(mount['tar'])
+            mountable_users[instance_dir].append(entry_path)
+    return image_dir
+
+
+def release_instance(plan, instance_dir):
+    """
+    Undo provision_instance: unmount the root filesystem and hand the
+    directory to the background reaper. The container's own mounts went
+    away with its mount namespace
+    :param plan: the config's launch plan
+    :param instance_dir: the instance's directory
     :return: None
     """
-    image_dir = osp.join(container_dir, instance_name, 'basefs')
-    instance_info = instances.pop(instance_name)
-    container_process = container_dict.pop(instance_name)
-    # kill the whole group of container process
-    os.killpg(container_process.pid, signal.SIGKILL)
-
-    with open(osp.join(config_dir, '{}-{}-{}.cfg'.format(instance_info['name'],
-                                                         instance_info['major'],
-                                                         instance_info['minor']))) as fp:
-        config_obj = json.load(fp)
-    # umount all mounted files
-    mount_paths = [mount_config.split(' ')[1] for mount_config in config_obj['mounts']]
-    mount_paths.sort()
-    mount_paths.reverse()
-    for mount_path in mount_paths:
-        if mount_path[0] == '/':
-            mount_path = mount_path[1:]
-        mount_path = osp.join(image_dir, mount_path)
-        os.system('umount -l {}'.format(mount_path))
-    # umount proc
-    os.system('chroot {} /bin/bash -c "umount proc"'.format(image_dir))
+    # umount the overlay root
+    detach(osp.join(instance_dir, 'basefs'))
+    release_mountables(instance_dir)
     # remove container directory
-    os.system('rm -rf {}'.format(osp.join(container_dir, instance_name)))
+    with teardown_phase_seconds.time(phase='discard'):
+        discard_dir(instance_dir)
+
+
+def detach(mount_path):
+    """
+    Lazily unmount a path, logging rather than raising on failure so a
+    teardown always runs to the end
+    :param mount_path: the mount point
+    :return: None
+    """
+    try:
+        with teardown_phase_seconds.time(phase='umount'):
+            syscalls.umount(mount_path)
+    except syscalls.SyscallError as e:
+        print('teardown: {}'.format(e))
+
+
+def discard_dir(dir_path):
+    """
+    Move a directory into the trash and let the reaper delete it later
+    :param dir_path: the directory path
+    :return: None
+    """
+    global trash_thread
+    with trash_lock:
+        if trash_thread is None:
+            trash_thread = threading.Thread(target=trash_reaper, daemon=True)
+            trash_thread.start()
+            # pick up whatever an earlier run left behind
+            if osp.exists(trash_dir):
+                for name in os.listdir(trash_dir):
+                    trash_pending[name] = time.time()
+                    trash_queue.put(osp.join(trash_dir, name))
+        trash_counter['discarded'] += 1
+        name = '{}-{}'.format(osp.basename(dir_path), uuid.uuid4().hex[:8])
+        trash_pending[name] = time.time()
+    create_dir_if_not_exists(trash_dir)
+    os.rename(dir_path, osp.join(trash_dir, name))
+    trash_queue.put(osp.join(trash_dir, name))
+
+
+def trash_reaper():
+    """
+    Background thread deleting discarded directories
+    :return: None
+    """
+    while True:
+        trash_path = trash_queue.get()
+        # never recurse into something that is still mounted
+        for mount_path in syscalls.mount_points(trash_path):
+            detach(mount_path)
+        try:
+            with teardown_phase_seconds.time(phase='rm'):
+                syscalls.rmtree(trash_path)
+        except syscalls.SyscallError as e:
+            print('reaper: {}'.format(e))
+        with trash_lock:
+            trash_pending.pop(osp.basename(trash_path), None)
+            trash_counter['reclaimed'] += 1
+
+
+def claim_warm_root(plan):
+    """
+    Take a ready instance directory out of a config's warm pool
+    :param plan: the config's launch plan
+    :return: the directory, or None when the pool is empty or disabled
+    """
+    if plan['warm_pool'] == 0:
+        return None
+    with warm_pool_lock:
+        pool = warm_pools.get(plan['file'])
+        stats = warm_pool_stats.setdefault(plan['file'], Counter())
+        if not pool:
+            stats['misses'] += 1
+            return None
+        stats['hits'] += 1
+        return pool.pop()
+
+
+def refill_warm_pool(config_file):
+    """
+    Ask the background refiller to top up a config's warm pool
+    :param config_file: the config file name
+    :return: None
+    """
+    global warm_pool_thread
+    with warm_pool_lock:
+        if warm_pool_thread is None:
+            warm_pool_thread = threading.Thread(target=warm_pool_refiller, daemon=True)
+            warm_pool_thread.start()
+    warm_pool_queue.put(config_file)
+
+
+def warm_pool_refiller():
+    """
+    Background thread provisioning roots until each requested pool is full
+    :return: None
+    """
+    while True:
+        config_file = warm_pool_queue.get()
+        plan = configs.get(config_file)
+        if plan is None:
+            continue
+        while True:
+            with warm_pool_lock:
+                pool = warm_pools.setdefault(config_file, [])
+                if len(pool) >= plan['warm_pool']:
+                    break
+                warm_pool_counter['roots'] += 1
+                warm_root = osp.join(warm_dir, '{}-{}'.format(config_file,
+                                                              warm_pool_counter['roots']))
+            create_dir_if_not_exists(warm_dir)
+            start = time.time()
+            try:
+                provision_instance(plan, warm_root)
+            except Exception as e:
+                print('warm pool refill for {} failed: {}'.format(config_file, e))
+                break
+            latency = time.time() - start
+            with warm_pool_lock:
+                pool.append(warm_root)
+                stats = warm_pool_stats.setdefault(config_file, Counter())
+                stats['refills'] += 1
+                stats['refill_seconds'] += latency
+                stats['last_refill_seconds'] = latency
+
+
+@atexit.register
+def drain_warm_pools():
+    """
+    Release every unclaimed warm root so no mounts outlive the manager
+    :return: None
+    """
+    with warm_pool_lock:
+        pools = {config_file: warm_pools.pop(config_file)
+                 for config_file in list(warm_pools)}
+    for config_file, pool in pools.items():
+        for warm_root in pool:
+            release_instance(configs[config_file], warm_root)
+
+
+def tar_digest(tar_path):
+    """
+    Compute the sha256 of a tarball, cached by its mtime and size
+    :param tar_path: the path of the tarball
+    :return: the hex digest of the tarball
+    """
+    try:
+        stat = os.stat(tar_path)
+    except OSError as e:
+        raise syscalls.SyscallError('stat', tar_path, e.errno)
+    cached = tar_digests.get(tar_path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(tar_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    tar_digests[tar_path] = (stat.st_mtime, stat.st_size, sha.hexdigest())
+    return sha.hexdigest()
+
+
+def store_key_lock(entry_path):
+    """
+    The lock serializing the extraction of one store entry
+    :param entry_path: the store entry path
+    :return: a lock
+    """
+    with store_lock:
+        return store_key_locks.setdefault(entry_path, threading.Lock())
+
+
+def extract_cached(tar_path, store_dir, on_ready=None, prepare=None):
+    """
+    Extract a tarball once into a content-addressed store. The tarball is
+    unpacked into a temporary directory and renamed into place, and
+    concurrent callers for the same content wait for a single extraction
+    :param tar_path: the path of the tarball
+    :param store_dir: the store directory
+    :param on_ready: called with the entry path while the entry is locked
+    :param prepare: called with the temporary directory of a new extraction
+            before it is renamed into place
+    :return: the path of the extracted entry
+    """
+    entry_path = osp.join(store_dir, tar_digest(tar_path))
+    with store_key_lock(entry_path):
+        if not osp.exists(entry_path):
+            create_dir_if_not_exists(store_dir)
+            # extract aside and rename, so a crash never leaves a partial entry
+            tmp_path = '{}.tmp-{}'.format(entry_path, uuid.uuid4().hex[:8])
+            syscalls.makedirs(tmp_path)
+            try:
+                syscalls.extract_tar(tar_path, tmp_path)
+                if prepare is not None:
+                    prepare(tmp_path)
+            except (OSError, syscalls.SyscallError):
+                syscalls.rmtree(tmp_path)
+                raise
+            os.rename(tmp_path, entry_path)
+        if on_ready is not None:
+            on_ready(entry_path)
+    return entry_path
+
+
+def entry_root(entry_path, top_dir=None):
+    """
+    The directory to use out of an extracted tarball: the named top level
+    directory, or the only one, or the entry itself
+    :param entry_path: the store entry path
+    :param top_dir: the expected top level directory name
+    :return: the directory path
+    """
+    if top_dir is not None and osp.isdir(osp.join(entry_path, top_dir)):
+        return osp.join(entry_path, top_dir)
+    entries = os.listdir(entry_path)
+    if len(entries) == 1 and osp.isdir(osp.join(entry_path, entries[0])):
+        return osp.join(entry_path, entries[0])
+    return entry_path
+
+
+def dir_size(dir_path):
+    """
+    :param dir_path: the directory path
+    :return: the apparent size in bytes of every file below the directory
+    """
+    total = 0
+    for parent, _, files in os.walk(dir_path):
+        for name in files:
+            total += os.lstat(osp.join(parent, name)).st_size
+    return total
+
+
+def acquire_mountable(tar_path):
+    """
+    Extract a mountable into the store if needed and pin it for an instance
+    :param tar_path: the path of the mountable tarball
+    :return: the store entry path
+    """
+    global store_adopted
+    with store_lock:
+        if not store_adopted and osp.exists(mountable_store_dir):
+            # adopt what an earlier run extracted and sweep half-done extractions
+            for name in os.listdir(mountable_store_dir):
+                path = osp.join(mountable_store_dir, name)
+                if '.tmp-' in name:
+                    syscalls.rmtree(path)
+                else:
+                    store_entries[path] = dir_size(path)
+        store_adopted = True
+    entry_path = extract_cached(tar_path, mountable_store_dir, on_ready=pin_mountable)
+    evict_mountables()
+    return entry_path
+
+
+def pin_mountable(entry_path):
+    """
+    Mark a mountable store entry as used by one more instance
+    :param entry_path: the store entry path
+    :return: None
+    """
+    with store_lock:
+        if entry_path not in store_entries:
+            store_entries[entry_path] = dir_size(entry_path)
+        store_entries.move_to_end(entry_path)
+        store_refs[entry_path] += 1
+
+
+def unpin_mountable(entry_path):
+    """
+    Mark a mountable store entry as used by one less instance
+    :param entry_path: the store entry path
+    :return: None
+    """
+    with store_lock:
+        store_refs[entry_path] -= 1
+        if store_refs[entry_path] <= 0:
+            del store_refs[entry_path]
+
+
+def release_mountables(instance_dir):
+    """
+    Unpin the mountables an instance was using
+    :param instance_dir: the instance's directory
+    :return: None
+    """
+    for entry_path in mountable_users.pop(instance_dir, []):
+        unpin_mountable(entry_path)
+    evict_mountables()
+
+
+def evict_mountables():
+    """
+    Drop least recently used mountables no instance is using until the
+    store fits in MOUNTABLE_CACHE_BYTES
+    :return: None
+    """
+    evicted = []
+    with store_lock:
+        total = sum(store_entries.values())
+        for entry_path in list(store_entries):
+            if total <= mountable_cache_bytes:
+                break
+            key_lock = store_key_locks.setdefault(entry_path, threading.Lock())
+            # skip entries that are in use or being extracted right now
+            if store_refs[entry_path] > 0 or not key_lock.acquire(blocking=False):
+                continue
+            try:
+                total -= store_entries.pop(entry_path)
+                evicted_path = '{}.tmp-evicted-{}'.format(entry_path, uuid.uuid4().hex[:8])
+                os.rename(entry_path, evicted_path)
+                evicted.append(evicted_path)
+            finally:
+                key_lock.release()
+    for evicted_path in evicted:
+        syscalls.rmtree(evicted_path)
+
+
+def image_lower_dirs(plan):
+    """
+    Find the read-only layers of a config's root filesystem, extracting the
+    base image if needed
+    :param plan: the config's launch plan
+    :return: the layer directories, top first, ending with the base image
+    """
+    with launch_phase_seconds.time(phase='base_extract'):
+        base_dir = import_image(plan['base'])
+    return [osp.join(layer_dir, layer) for layer in plan['layers']] + [base_dir]
+
+
+def import_image(image_name):
+    """
+    Import a base image tarball into the image store, once per content. The
+    files of a new extraction are deduplicated against every image imported
+    before, and the image is indexed by its name in a manifest, so it stays
+    usable after its tarball is removed from base_images
+    :param image_name: the tarball name in base_images
+    :return: the image's root directory
+    :raises SyscallError: if there is no such tarball or it cannot be extracted
+    """
+    tar_path = osp.join(base_images_dir, image_name)
+    manifest = None
+    if osp.exists(tar_path):
+        digest = tar_digest(tar_path)
+    else:
+        manifest = image_manifest(image_name)
+        if manifest is None:
+            raise syscalls.SyscallError('image', tar_path, errno.ENOENT)
+        digest = manifest['digest']
+    cached = image_roots.get(image_name)
+    if cached is not None and cached[0] == digest and osp.isdir(cached[1]):
+        return cached[1]
+    stats = {}
+    entry_path = extract_cached(tar_path, image_cache_dir, prepare=lambda tmp_path: stats.update(dedupe_files(tmp_path)))
+    with image_lock:
+        manifest = image_manifest(image_name) if manifest is None else manifest
+        if manifest is None or manifest['digest'] != digest:
+            if not stats:
+                # the same content was imported under another name, or before deduplication
+                stats = dedupe_files(entry_path)
+            write_image_manifest(dict(stats, image=image_name, kind='tarball', digest=digest,
+                                      imported=time.time()))
+        image_roots[image_name] = (digest, entry_root(entry_path))
+    return image_roots[image_name][1]
+
+
+def dedupe_files(dir_path):
+    """
+    Replace every regular file below a directory by a hard link to the same
+    file in the image object store, adding the files the store does not have
+    yet. Files are the same when their content, mode and owner are, since a
+    hard link shares all three; the first image's mtime wins. The images are
+    only ever overlay lower layers, so no container writes through the links
+    :param dir_path: the directory, not yet used by any container
+    :return: the number and bytes of its files, and of those already in the
+            store
+    """
+    stats = {'files': 0, 'bytes': 0, 'shared_files': 0, 'shared_bytes': 0}
+    for parent, _, files in os.walk(dir_path):
+        for name in files:
+            path = osp.join(parent, name)
+            stat = os.lstat(path)
+            if not S_ISREG(stat.st_mode):
+                continue
+            sha = hashlib.sha256()
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    sha.update(chunk)
+            key = '{}-{:o}-{}-{}'.format(sha.hexdigest(), S_IMODE(stat.st_mode), stat.st_uid, stat.st_gid)
+            object_path = osp.join(image_object_dir, key[:2], key)
+            stats['files'] += 1
+            stats['bytes'] += stat.st_size
+            try:
+                if osp.samefile(path, object_path):
+                    stats['shared_files'] += 1
+                    stats['shared_bytes'] += stat.st_size
+                    continue
+                # link aside and rename over the file, so it is never missing
+                link_path = osp.join(parent, '.dedupe-' + uuid.uuid4().hex[:8])
+                os.link(object_path, link_path)
+                os.rename(link_path, path)
+                stats['shared_files'] += 1
+                stats['shared_bytes'] += stat.st_size
+            except FileNotFoundError:
+                os.makedirs(osp.dirname(object_path), exist_ok=True)
+                try:
+                    os.link(path, object_path)
+                except FileExistsError:
+                    pass
+            except OSError as e:
+                # too many links to one file: keep this copy
+                if e.errno != errno.EMLINK:
+                    raise
+    return stats
+
+
+def collect_image_objects():
+    """
+    Drop the files of the image object store that no image links any more
+    :return: the bytes freed
+    """
+    freed = 0
+    if not osp.exists(image_object_dir):
+        return freed
+    for parent, _, files in os.walk(image_object_dir):
+        for name in files:
+            path = osp.join(parent, name)
+            stat = os.lstat(path)
+            if stat.st_nlink == 1:
+                os.unlink(path)
+                freed += stat.st_size
+    return freed
+
+
+def sweep_image_store():
+    """
+    Remove what a crashed manager left half done in the image store:
+    extractions and deletions of base images and copies of committed layers,
+    then the object store files only they linked
+    :return: None
+    """
+    swept = False
+    for store_dir, marker in [(image_cache_dir, '.tmp-'), (layer_dir, '.tmp')]:
+        if not osp.exists(store_dir):
+            continue
+        for name in os.listdir(store_dir):
+            if marker in name:
+                syscalls.rmtree(osp.join(store_dir, name))
+                swept = True
+    if swept:
+        collect_image_objects()
+
+
+def provision_rootfs(lower_dirs, instance_dir):
+    """
+    Give an instance its own writable root on top of cached image layers. An
+    overlayfs is used when possible, otherwise the layers are cloned bottom
+    up (with reflinks where the filesystem supports them)
+    :param lower_dirs: the image layer directories, top first
+    :param instance_dir: the instance's directory
+    :return: the path of the instance's root directory
+    """
+    image_dir = osp.join(instance_dir, 'basefs')
+    upper_dir = osp.join(instance_dir, 'upper')
+    work_dir = osp.join(instance_dir, 'work')
+    for path in (image_dir, upper_dir, work_dir):
+        syscalls.makedirs(path)
+    try:
+        syscalls.mount('overlay', image_dir, 'overlay', 0,
+                       'lowerdir={},upperdir={},workdir={}'.format(':'.join(lower_dirs), upper_dir, work_dir))
+    except syscalls.SyscallError:
+        for lower_dir in reversed(lower_dirs):
+            syscalls.run(['cp', '-a', '--reflink=auto', lower_dir + '/.', image_dir])
+            remove_whiteouts(image_dir, lower_dir)
+    return image_dir
+
+
+def remove_whiteouts(image_dir, lower_dir):
+    """
+    Delete what a committed layer deleted from a root cloned without
+    overlayfs: the layer marks each deleted file with a 0/0 character device
+    :param image_dir: the cloned root
+    :param lower_dir: the layer just copied into it
+    :return: None
+    """
+    for parent, dirs, files in os.walk(lower_dir):
+        for name in dirs + files:
+            stat = os.lstat(osp.join(parent, name))
+            if S_ISCHR(stat.st_mode) and stat.st_rdev == 0:
+                # the copy replaced the deleted file with the marker
+                os.unlink(osp.join(image_dir, osp.relpath(osp.join(parent, name), lower_dir)))
 
 
 def create_dir_if_not_exists(dir_path):
@@ -218,8 +2601,7 @@ def create_dir_if_not_exists(dir_path):
     :param dir_path: the directory path
     :return: None
     """
-    if not osp.exists(dir_path):
-        os.makedirs(dir_path)
+    syscalls.makedirs(dir_path)
     unlock(dir_path)
 
 
@@ -229,55 +2611,383 @@ def unlock(path):
     :param path: the path of the unlocked file or directory
     :return: None
     """
-    os.system('sudo chmod 777 {}'.format(path))
+    syscalls.chmod(path, 0o777)
 
 
-def start_container(image_dir, config_obj):
+def start_container(image_dir, plan, cgroup_dir=None):
     """
-    The container subprocess
+    Start the container's startup script, in a new session so the whole
+    container is one process group. Nothing runs in the manager's child
+    between fork and exec: a shell joins the container's cgroup and execs
+    unshare, which gives it mount and pid namespaces of its own, and a second
+    shell there mounts the mountables, so none of them show up in the host's
+    mount table, and execs chroot. The mount points are created beforehand,
+    see make_mount_points.
+    Its stdout and stderr go to the console FIFO of the instance directory,
+    opened read-write so that the container can never get SIGPIPE: while no
+    manager drains it, a chatty container blocks once the pipe is full
+    instead of dying. A failing mount ends the container with the error in
+    its logs
     :param image_dir: container's image directory
-    :param config_obj: config object
+    :param plan: the config's launch plan
+    :param cgroup_dir: the container's cgroup, if any
+    :return: the container's process
+    """
+    binds = [(entry_root(entry_path, mount['top_dir']), osp.join(image_dir, mount['target']), mount['readonly'])
+             for mount, entry_path in zip(plan['mounts'], mountable_users[osp.dirname(image_dir)])]
+    overlays = make_mount_points(binds, osp.dirname(image_dir))
+    script = plan['config']['startup_script']
+    if plan['env']:
+        script = 'export {} {}'.format(plan['env'], script)
+    commands = []
+    for (source, target, _), overlay in zip(binds, overlays):
+        if overlay is None:
+            commands.append('mount --bind {} {}'.format(shlex.quote(source), shlex.quote(target)))
+        else:
+            options = 'lowerdir={},upperdir={},workdir={}'.format(source, *overlay)
+            commands.append('mount -t overlay overlay -o {} {}'.format(shlex.quote(options), shlex.quote(target)))
+    # read-only last, like the overlay roots of the instances
+    commands += ['mount -o remount,bind,ro {}'.format(shlex.quote(target))
+                 for _, target, readonly in binds if readonly]
+    commands.append('exec chroot {} /bin/bash -c {}'.format(shlex.quote(image_dir), shlex.quote(script)))
+    argv = ['unshare', '-m', '-p', '-f', '--mount-proc={}'.format(osp.join(image_dir, 'proc')),
+            '/bin/sh', '-c', ' && '.join(commands)]
+    if cgroup_dir is not None:
+        argv = ['/bin/sh', '-c', 'echo 0 > {} && exec "$@"'.format(shlex.quote(osp.join(cgroup_dir, 'cgroup.procs'))),
+                'sh'] + argv
+    console_path = osp.join(osp.dirname(image_dir), 'console')
+    try:
+        os.mkfifo(console_path, 0o600)
+    except FileExistsError:
+        pass
+    console_fd = os.open(console_path, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        return subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=console_fd, stderr=console_fd,
+                                start_new_session=True)
+    finally:
+        os.close(console_fd)
+
+
+def make_mount_points(binds, instance_dir):
+    """
+    Create the mount points of a container's mounts without touching the
+    shared store entries: a mountable that lacks the mount point of a mount
+    nested in it is mounted through an overlay of the instance's own, whose
+    upper directory gets the mount point
+    :param binds: (source, mount point, read-only) of each mount, parents first
+    :param instance_dir: the instance's directory
+    :return: for each mount, None to bind it or the overlay's upper and work
+            directories
+    """
+    overlays = [None] * len(binds)
+    for index, (_, target, _) in enumerate(binds):
+        for parent_index in range(index - 1, -1, -1):
+            source, parent, _ = binds[parent_index]
+            if target.startswith(parent.rstrip('/') + '/'):
+                rel_path = osp.relpath(target, parent)
+                if not osp.isdir(osp.join(source, rel_path)):
+                    if overlays[parent_index] is None:
+                        overlay_dir = osp.join(instance_dir, 'mounts', str(parent_index))
+                        overlays[parent_index] = (osp.join(overlay_dir, 'upper'), osp.join(overlay_dir, 'work'))
+                        syscalls.makedirs(overlays[parent_index][1])
+                    syscalls.makedirs(osp.join(overlays[parent_index][0], rel_path))
+                break
+        else:
+            syscalls.makedirs(target)
+    return overlays
+
+
+def watch_container(instance_name, container_process):
+    """
+    Have the reaper collect a container's process as soon as it exits
+    :param instance_name: the instance name
+    :param container_process: the container's process
     :return: None
     """
-    startup_env = config_obj['startup_env']
-    if startup_env[-1] != ';':
-        startup_env = startup_env + ';'
-    os.system('unshare -p -f --mount-proc={} chroot {} /bin/bash -c "export {} {}"'.format(osp.join(image_dir, 'proc'),
-                                                                                           image_dir, startup_env,
-                                                                                           config_obj[
-                                                                                               'startup_script']))
-
-
-def execute_mount(mount_argv, image_dir):
-    """
-    Mount files to the container image directory
-    :param mount_argv: all mount config arguments
-    :param image_dir: the path of container image directory
-    :return: None
-    """
-    filename = mount_argv.split(" ")[0]
-    file_folder = filename.split(".")[0]
-    folder = mount_argv.split(" ")[1]
-    if folder[0] == '/':
-        folder = folder[1:]
-    access = mount_argv.split(" ")[2]
-    mountables_path = osp.join(os.getcwd(), "mountables")
-    file_path = osp.join(mountables_path, filename)
-    file_folder = osp.join(mountables_path, file_folder)
-    folder_path = osp.join(image_dir, folder)
-    if not osp.exists(folder_path):
-        os.system('sudo mkdir {}'.format(folder_path))
-    if not osp.exists(file_folder):
-        os.system('tar -xf {} -C {}'.format(file_path, mountables_path))
-    if access == "READ":
-        os.system('sudo mount --bind -o ro {} {}'.format(file_folder, folder_path))
-    else:
-        os.system('sudo mount --bind -o rw {} {}'.format(file_folder, folder_path))
+    global reaper_thread
+    with reaper_lock:
+        if reaper_thread is None:
+            reaper_thread = threading.Thread(target=container_reaper, daemon=True)
+            reaper_thread.start()
+        try:
+            pidfd = os.pidfd_open(container_process.pid)
+        except (AttributeError, OSError):
+            # no pidfd support, the reaper falls back to polling
+            pidfd = None
+        reaper_watched[container_process.pid] = (instance_name, container_process, pidfd)
+        if pidfd is not None:
+            reaper_selector.register(pidfd, selectors.EVENT_READ, container_process.pid)
+    os.write(reaper_wakeup[1], b'x')
+
+
+def container_reaper():
+    """
+    Background thread reaping container processes and supervising them. It
+    sleeps on one pidfd per container (plus a wakeup pipe) until an exit or
+    the next scheduled restart, so exits are noticed immediately and no
+    zombies are left behind
+    :return: None
+    """
+    reaper_selector.register(reaper_wakeup[0], selectors.EVENT_READ, None)
+    while True:
+        with reaper_lock:
+            polling = any(pidfd is None for _, _, pidfd in reaper_watched.values())
+            timeout = 0.5 if polling else None
+            if restart_queue:
+                # wake up for the next restart that is due
+                timeout = max(0.0, min(timeout or float('inf'), restart_queue[0][0] - time.time()))
+        events = reaper_selector.select(timeout=timeout)
+        exits, due = [], []
+        with reaper_lock:
+            if any(key.data is None for key, _ in events):
+                os.read(reaper_wakeup[0], 4096)
+            pids = [key.data for key, _ in events if key.data is not None]
+            if polling:
+                pids += [pid for pid, (_, _, pidfd) in reaper_watched.items() if pidfd is None]
+            for pid in pids:
+                instance_name, container_process, pidfd = reaper_watched[pid]
+                if not process_exited(container_process):
+                    continue
+                del reaper_watched[pid]
+                if pidfd is not None:
+                    reaper_selector.unregister(pidfd)
+                    os.close(pidfd)
+                exits.append((instance_name, container_process))
+            while restart_queue and restart_queue[0][0] <= time.time():
+                due.append(heapq.heappop(restart_queue))
+        # one failure must not stop the supervision of every other container
+        for instance_name, container_process in exits:
+            print('{} exited with {}'.format(instance_name, container_process.returncode))
+            try:
+                # the exit status of an adopted container is unknown
+                returncode = container_process.returncode
+                emit_event('exited', instance_name,
+                           exit_code=returncode if returncode is not None and returncode >= 0 else None,
+                           signal=-returncode if returncode is not None and returncode < 0 else None)
+                supervise_exit(instance_name, container_process)
+            except Exception as e:
+                print('supervising the exit of {} failed: {}'.format(instance_name, e))
+        for _, instance_name, container_process in due:
+            try:
+                launch_executor.submit(restart_container, instance_name, container_process)
+            except Exception as e:
+                print('restart of {} failed: {}'.format(instance_name, e))
+
+
+def supervise(instance_name, container_process):
+    """
+    Hand a started container to the supervisor, which applies the restart
+    policy of its config when it exits
+    :param instance_name: the instance name
+    :param container_process: the container's process
+    :return: None
+    """
+    with registry_lock:
+        if container_dict.get(instance_name) is not container_process:
+            return
+        supervised_instances[instance_name] = time.time()
+    if process_exited(container_process):
+        # it exited before the reaper knew it was supervised
+        supervise_exit(instance_name, container_process)
+
+
+def supervise_exit(instance_name, container_process):
+    """
+    Apply the restart policy of an instance whose container exited:
+    schedule a restart, or free the instance's root filesystem, mounts and
+    cgroup and keep it listed as exited until it is destroyed
+    :param instance_name: the instance name
+    :param container_process: the exited process
+    :return: None
+    """
+    with registry_lock:
+        if instance_name not in supervised_instances or instance_name in restarting_instances or \
+                container_dict.get(instance_name) is not container_process:
+            return
+        record = instances[instance_name]
+        plan = configs[config_file_name(record['name'], record['major'], record['minor'])]
+        policy = plan['restart']
+        # a container that stayed up longer than the longest backoff starts over
+        if time.time() - supervised_instances[instance_name] >= policy['max_backoff']:
+            restart_counts.pop(instance_name, None)
+        restarts = restart_counts[instance_name]
+        failed = container_process.returncode != 0
+        if (policy['policy'] == 'always' or (policy['policy'] == 'on-failure' and failed)) and \
+                (policy['max_restarts'] is None or restarts < policy['max_restarts']):
+            delay = restart_delay(policy, restarts)
+            restart_counts[instance_name] += 1
+            restarting_instances[instance_name] = time.time() + delay
+            touch_instances()
+        else:
+            delay = None
+            del container_dict[instance_name]
+            del supervised_instances[instance_name]
+            cgroup_dir = container_cgroups.pop(instance_name, None)
+            frozen_instances.pop(instance_name, None)
+            exited_instances[instance_name] = container_process.returncode
+            touch_instances()
+    if delay is not None:
+        with reaper_lock:
+            heapq.heappush(restart_queue, (restarting_instances[instance_name], instance_name, container_process))
+        os.write(reaper_wakeup[1], b'x')
+        emit_event('restarting', instance_name, restarts=restarts + 1, delay=delay)
+        return
+    instance_journal.append({'op': 'destroy', 'instance': instance_name})
+    with operations_in_flight.track(kind='teardown'):
+        kill_container(container_process, cgroup_dir)
+        release_instance(plan, osp.join(container_dir, instance_name))
+        remove_cgroup(cgroup_dir)
+
+
+def restart_delay(policy, restarts):
+    """
+    :param policy: a compiled restart policy
+    :param restarts: the restarts in a row so far
+    :return: the seconds to wait before the next restart: none for the
+            first, then backoff doubling up to max_backoff
+    """
+    if not restarts:
+        return 0
+    # past 2 ** 32 any backoff is above max_backoff, and the float stays finite
+    return min(policy['backoff'] * 2 ** min(restarts - 1, 32), policy['max_backoff'])
+
+
+def restart_container(instance_name, exited_process):
+    """
+    Start an instance's startup script again, in the root filesystem, mounts
+    and cgroup it already has
+    :param instance_name: the instance name
+    :param exited_process: the process that exited
+    :return: None
+    """
+    with registry_lock:
+        if container_dict.get(instance_name) is not exited_process or instance_name not in restarting_instances:
+            return
+        record = instances[instance_name]
+        cgroup_dir = container_cgroups.get(instance_name)
+    plan = configs[config_file_name(record['name'], record['major'], record['minor'])]
+    # what the startup process left behind goes first
+    kill_container(exited_process, cgroup_dir)
+    if cgroup_dir is not None:
+        cgroups.wait_empty(cgroup_dir)
+    try:
+        container_process = start_container(osp.join(container_dir, instance_name, 'basefs'), plan, cgroup_dir)
+    except syscalls.SyscallError as e:
+        print('restart of {} failed: {}'.format(instance_name, e))
+        with registry_lock:
+            restarting_instances.pop(instance_name, None)
+            supervised_instances[instance_name] = time.time()
+        # counts as one more exit
+        supervise_exit(instance_name, exited_process)
+        return
+    watch_container(instance_name, container_process)
+    with registry_lock:
+        restarted = container_dict.get(instance_name) is exited_process and \
+            restarting_instances.pop(instance_name, None) is not None
+        if restarted:
+            container_dict[instance_name] = container_process
+            supervised_instances[instance_name] = time.time()
+            touch_instances()
+            capture_logs(instance_name, osp.join(container_dir, instance_name))
+    if not restarted:
+        # destroyed meanwhile, its teardown did the rest
+        kill_container(container_process, cgroup_dir)
+        return
+    restarts_total.inc(config=plan['file'])
+    journal_start(instance_name, container_process, cgroup_dir)
+    emit_event('restarted', instance_name, pid=container_process.pid, restarts=restart_counts[instance_name])
+    if process_exited(container_process):
+        # it exited before the reaper knew it was the instance's container
+        supervise_exit(instance_name, container_process)
+
+
+def process_exited(container_process):
+    """
+    :param container_process: a container's process, started by us or adopted
+    :return: whether it has exited; our own children are reaped here
+    """
+    if isinstance(container_process, AdoptedProcess):
+        return container_process.exited()
+    return container_process.poll() is not None
+
+
+def process_start_time(pid):
+    """
+    :param pid: a process id
+    :return: when the process started, in clock ticks after boot, which
+            tells a process from a later one reusing its pid; None if there
+            is no such process (or only its zombie)
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fp:
+            fields = fp.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return int(fields[19]) if fields[0] != 'Z' else None
+
+
+class AdoptedProcess:
+    """
+    A container process started by an earlier run of the manager. It is not
+    our child, so it is watched through its pid and start time and its exit
+    status cannot be known
+    """
+
+    def __init__(self, pid, start_time):
+        self.pid = pid
+        self.start_time = start_time
+        self.returncode = None
+
+    def exited(self):
+        """
+        :return: whether the process is gone
+        """
+        return process_start_time(self.pid) != self.start_time
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='container manager')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--production', action='store_true',
+                        help='serve with waitress instead of the Flask development server')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='worker threads of the production server')
+    parser.add_argument('--clean', action='store_true',
+                        help='start from scratch: run "make clean" instead of restoring configs and instances')
+    parser.add_argument('--data-dir',
+                        help='keep configs, containers and state in this directory instead of next to server.py')
+    parser.add_argument('--node-index', type=int, default=0,
+                        help="this manager's index in a cluster, for cluster-wide unique instance names")
+    parser.add_argument('--node-count', type=int, default=1,
+                        help='the number of managers in the cluster')
+    args = parser.parse_args()
+    if not 0 <= args.node_index < args.node_count:
+        parser.error('--node-index must be below --node-count')
+    node_index, node_count = args.node_index, args.node_count
     os.chdir(root_dir)
-    os.system('make clean')
+    if args.data_dir is not None:
+        use_data_dir(args.data_dir)
+        if args.clean:
+            for mount_path in syscalls.mount_points(args.data_dir):
+                detach(mount_path)
+            syscalls.rmtree(osp.realpath(args.data_dir))
+    elif args.clean:
+        subprocess.run(['make', 'clean'], check=False)
+    # exit through atexit handlers so warm roots get unmounted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     create_dir_if_not_exists(config_dir)
     create_dir_if_not_exists(container_dir)
-    app.run(host='localhost', port=8080)
+    sweep_image_store()
+    load_configs()
+    restore_instances()
+    if args.production:
+        try:
+            from waitress import serve
+        except ImportError:
+            sys.exit('--production needs waitress, run "make install" first')
+        # leave at least half of the worker threads to the other requests
+        max_streams = min(max_streams, max(1, args.threads // 2))
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        app.run(host=args.host, port=args.port, threaded=True)
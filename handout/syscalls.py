@@ -0,0 +1,164 @@
+"""
+Native filesystem and mount operations used by the container manager.
+
+Everything here calls the kernel (through ctypes) or the os module directly
+instead of forking a shell, and failures are raised as SyscallError so the
+caller knows which operation failed, on which path and with which errno.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path as osp
+import shutil
+import subprocess
+import tarfile
+
+MNT_DETACH = 0x2
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                       ctypes.c_ulong, ctypes.c_char_p]
+libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+
+class SyscallError(OSError):
+    """
+    A failed system call, with the operation and path it was applied to
+    """
+
+    def __init__(self, op, path, err):
+        super().__init__(err, '{}: {}'.format(op, os.strerror(err)), path)
+        self.op = op
+
+    def to_dict(self):
+        """
+        :return: a json-friendly description of the error
+        """
+        return {
+            'op': self.op,
+            'path': self.filename,
+            'errno': errno.errorcode.get(self.errno, self.errno),
+            'error': self.strerror,
+        }
+
+
+def _encode(value):
+    return value.encode() if value is not None else None
+
+
+def mount(source, target, fstype=None, flags=0, data=None):
+    """
+    mount(2)
+    :param source: the source device or directory
+    :param target: the mount point
+    :param fstype: the filesystem type, None for bind mounts and remounts
+    :param flags: mount flags
+    :param data: filesystem specific options
+    :return: None
+    """
+    if libc.mount(_encode(source), _encode(target), _encode(fstype),
+                  flags, _encode(data)) != 0:
+        raise SyscallError('mount', target, ctypes.get_errno())
+
+
+def umount(target, lazy=True):
+    """
+    umount2(2)
+    :param target: the mount point
+    :param lazy: detach the mount even if it is busy
+    :return: True if something was unmounted, False if it was not mounted
+    """
+    if libc.umount2(_encode(target), MNT_DETACH if lazy else 0) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.EINVAL, errno.ENOENT):
+            return False
+        raise SyscallError('umount', target, err)
+    return True
+
+
+def makedirs(path, mode=0o777):
+    """
+    mkdir -p
+    :param path: the directory path
+    :param mode: the permission bits of the created directories
+    :return: None
+    """
+    try:
+        os.makedirs(path, mode=mode, exist_ok=True)
+    except OSError as e:
+        raise SyscallError('mkdir', path, e.errno)
+
+
+def chmod(path, mode):
+    """
+    chmod(2)
+    :param path: the file or directory path
+    :param mode: the permission bits
+    :return: None
+    """
+    try:
+        os.chmod(path, mode)
+    except OSError as e:
+        raise SyscallError('chmod', path, e.errno)
+
+
+def extract_tar(tar_path, dest_dir):
+    """
+    Stream a (possibly compressed) tarball into a directory, keeping
+    owners, permissions, links and device nodes
+    :param tar_path: the tarball path
+    :param dest_dir: the directory to extract into
+    :return: None
+    """
+    # a root filesystem needs absolute links and device nodes
+    options = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+    try:
+        with tarfile.open(tar_path, 'r|*') as tar:
+            tar.extractall(dest_dir, numeric_owner=True, **options)
+    except (OSError, tarfile.TarError) as e:
+        raise SyscallError('untar', tar_path, getattr(e, 'errno', None) or errno.EIO)
+
+
+def rmtree(path):
+    """
+    rm -rf
+    :param path: the directory path
+    :return: None
+    """
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        raise SyscallError('rmtree', e.filename or path, e.errno or errno.EIO)
+
+
+def run(argv):
+    """
+    Run an external program, for the few operations with no system call
+    equivalent
+    :param argv: the command line
+    :return: None
+    """
+    try:
+        result = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise SyscallError(argv[0], None, e.errno)
+    if result.returncode != 0:
+        raise SyscallError(argv[0], argv[-1], errno.EIO)
+
+
+def mount_points(prefix):
+    """
+    List the mount points at or below a directory, deepest first
+    :param prefix: the directory path
+    :return: a list of mount points
+    """
+    prefix = osp.realpath(prefix)
+    with open('/proc/self/mounts') as fp:
+        targets = [line.split(' ')[1].replace('\\040', ' ') for line in fp]
+    return sorted((target for target in targets
+                   if target == prefix or target.startswith(prefix + '/')),
+                  reverse=True)